@@ -16,25 +16,35 @@
 
 import base64
 import csv
+import functools
+import grp
+import hashlib
+import http.client
 import os
+import pwd
 import re
 import random
 import shutil
 import socket
+import stat
 import string
 import json
+import tempfile
+import time
 import ipaddress
 import traceback
 import yaml
 
 from charms.leadership import leader_get, leader_set
 
-from shutil import move, copyfile
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfile
 from pathlib import Path
 from subprocess import check_call
 from subprocess import check_output
 from subprocess import CalledProcessError
-from urllib.request import Request, urlopen
+from subprocess import run
+from urllib.parse import urlencode
 
 from charms.layer import snap
 from charms.reactive import hook
@@ -43,8 +53,9 @@ from charms.reactive import set_state, set_flag
 from charms.reactive import is_state, is_flag_set
 from charms.reactive import endpoint_from_flag
 from charms.reactive import when, when_any, when_not, when_none
-from charms.reactive.helpers import data_changed, any_file_changed
+from charms.reactive.helpers import data_changed
 
+from charms.layer import kubernetes_common
 from charms.layer import tls_client
 from charms.layer import vaultlocker
 from charms.layer import vault_kv
@@ -60,8 +71,6 @@ from charms.layer.hacluster import add_service_to_hacluster
 from charms.layer.hacluster import remove_service_from_hacluster
 from charms.layer.kubernetes_common import kubeclientconfig_path
 from charms.layer.kubernetes_common import migrate_resource_checksums
-from charms.layer.kubernetes_common import check_resources_for_upgrade_needed
-from charms.layer.kubernetes_common import calculate_and_store_resource_checksums  # noqa
 from charms.layer.kubernetes_common import arch
 from charms.layer.kubernetes_common import service_restart
 from charms.layer.kubernetes_common import get_ingress_address
@@ -76,7 +85,6 @@ from charms.layer.kubernetes_common import write_azure_snap_config
 from charms.layer.kubernetes_common import configure_kube_proxy
 from charms.layer.kubernetes_common import kubeproxyconfig_path
 from charms.layer.kubernetes_common import kubectl_manifest
-from charms.layer.kubernetes_common import get_version
 from charms.layer.kubernetes_common import retry
 from charms.layer.kubernetes_common import ca_crt_path
 from charms.layer.kubernetes_common import server_crt_path
@@ -90,7 +98,11 @@ from charms.layer.kubernetes_common import kubectl
 # Override the default nagios shortname regex to allow periods, which we
 # need because our bin names contain them (e.g. 'snap.foo.daemon'). The
 # default regex in charmhelpers doesn't allow periods, but nagios itself does.
-nrpe.Check.shortname_re = r'[\.A-Za-z0-9-_]+$'
+nrpe.Check.shortname_re = re.compile(r'[\.A-Za-z0-9-_]+$')
+
+version_number_re = re.compile('[0-9]+')
+# the Webhook entry of a comma separated authorization-mode
+webhook_mode_re = re.compile(r'(?:^|,)Webhook(?=,|$)')
 
 snap_resources = ['kubectl', 'kube-apiserver', 'kube-controller-manager',
                   'kube-scheduler', 'cdk-addons', 'kube-proxy']
@@ -100,12 +112,270 @@ master_services = ['kube-apiserver',
                    'kube-scheduler',
                    'kube-proxy']
 
-
-os.environ['PATH'] += os.pathsep + os.path.join(os.sep, 'snap', 'bin')
-db = unitdata.kv()
+# in-cluster names of the API service that do not depend on the dns_domain
+kubernetes_sans = ('kubernetes',
+                   'kubernetes.default',
+                   'kubernetes.default.svc')
+
+snapd_socket = '/run/snapd.socket'
+
+# translation table mapping random bytes onto [A-Za-z0-9]; the top
+# 256 % 62 byte values are deleted so every character is equally likely
+token_alphabet = (string.ascii_letters + string.digits).encode('ascii')
+token_bias = bytes(range(256 - 256 % len(token_alphabet), 256))
+token_table = bytes(token_alphabet[b % len(token_alphabet)]
+                    for b in range(256))
+
+# apiserver admission controllers by release; NodeRestriction is added
+# to the current list when the Node authorizer is enabled
+admission_control_pre_1_6 = ','.join([
+    'NamespaceLifecycle',
+    'LimitRanger',
+    'ServiceAccount',
+    'ResourceQuota',
+])
+admission_control_pre_1_9 = admission_control_pre_1_6 + \
+    ',DefaultTolerationSeconds'
+admission_control = ','.join([
+    'NamespaceLifecycle',
+    'LimitRanger',
+    'ServiceAccount',
+    'PersistentVolumeLabel',
+    'DefaultStorageClass',
+    'DefaultTolerationSeconds',
+    'MutatingAdmissionWebhook',
+    'ValidatingAdmissionWebhook',
+    'ResourceQuota'
+])
+
+# cloud integrations in order of precedence, as
+# (endpoint, cloud-provider, needs cloud-config)
+cloud_providers = (
+    ('aws', 'aws', False),
+    ('gcp', 'gce', True),
+    ('openstack', 'openstack', True),
+    ('vsphere', 'vsphere', True),
+    ('azure', 'azure', True),
+)
+
+# accepted dns-provider values, keyed by whether CoreDNS is supported
+# (kube-apiserver 1.14 and later)
+valid_dns_providers = {
+    True: frozenset(('auto', 'core-dns', 'kube-dns', 'none')),
+    False: frozenset(('auto', 'kube-dns', 'none')),
+}
+
+# service options naming files the service reads at startup, whose
+# contents are part of its restart fingerprint
+input_file_opts = frozenset((
+    'audit-policy-file',
+    'audit-webhook-config-file',
+    'authentication-token-webhook-config-file',
+    'authorization-webhook-config-file',
+    'basic-auth-file',
+    'client-ca-file',
+    'cloud-config',
+    'etcd-cafile',
+    'etcd-certfile',
+    'etcd-keyfile',
+    'experimental-encryption-provider-config',
+    'kubelet-certificate-authority',
+    'kubelet-client-certificate',
+    'kubelet-client-key',
+    'proxy-client-cert-file',
+    'proxy-client-key-file',
+    'requestheader-client-ca-file',
+    'root-ca-file',
+    'service-account-key-file',
+    'service-account-private-key-file',
+    'tls-cert-file',
+    'tls-private-key-file',
+    'token-auth-file',
+))
+
+# systemd services monitored through nrpe
+nrpe_services = ('snap.kube-apiserver.daemon',
+                 'snap.kube-controller-manager.daemon',
+                 'snap.kube-scheduler.daemon')
+
+cdk_addons_ceph_disabled = {
+    'enable-ceph': 'false',
+    'ceph-admin-key': '',
+    'ceph-kubernetes-key': '',
+    'ceph-mon-hosts': '""',
+    'default-storage': '',
+}
+
+cdk_addons_keystone_disabled = {
+    'enable-keystone': 'false',
+    'keystone-cert-file': '',
+    'keystone-key-file': '',
+    'keystone-server-url': '',
+    'keystone-server-ca': '',
+}
+
+
+snap_bin = os.path.join(os.sep, 'snap', 'bin')
+if snap_bin not in os.environ['PATH'].split(os.pathsep):
+    os.environ['PATH'] += os.pathsep + snap_bin
 checksum_prefix = 'kubernetes-master.resource-checksums.'
+# Keep kubectl's discovery cache on tmpfs, in a directory only root can use.
+kubectl_cache_dir = '/run/kubernetes-master/kube-cache'
 configure_prefix = 'kubernetes-master.prev_args.'
 keystone_root = '/root/cdk/keystone'
+audit_root = '/root/cdk/audit'
+etcd_dir = '/root/cdk/etcd'
+etcd_ca_path = etcd_dir + '/client-ca.pem'
+etcd_key_path = etcd_dir + '/client-key.pem'
+etcd_cert_path = etcd_dir + '/client-cert.pem'
+
+# string forms of the tls paths, for service options
+ca_crt_file = str(ca_crt_path)
+server_crt_file = str(server_crt_path)
+server_key_file = str(server_key_path)
+client_crt_file = str(client_crt_path)
+client_key_file = str(client_key_path)
+
+# kube-apiserver options that do not depend on config or relations
+apiserver_static_opts = {
+    # at one point in time, this code would set ca-client-cert,
+    # but this was removed. This was before configure_kubernetes_service
+    # kept track of old arguments and removed them, so client-ca-cert
+    # was able to hang around forever stored in the snap configuration.
+    # This removes that stale configuration from the snap if it still
+    # exists.
+    'client-ca-file': 'null',
+    'min-request-timeout': '300',
+    'v': '4',
+    'tls-cert-file': server_crt_file,
+    'tls-private-key-file': server_key_file,
+    'kubelet-certificate-authority': ca_crt_file,
+    'kubelet-client-certificate': client_crt_file,
+    'kubelet-client-key': client_key_file,
+    'logtostderr': 'true',
+    'insecure-bind-address': '127.0.0.1',
+    'insecure-port': '8080',
+    'basic-auth-file': '/root/cdk/basic_auth.csv',
+    'token-auth-file': '/root/cdk/known_tokens.csv',
+    'service-account-key-file': '/root/cdk/serviceaccount.key',
+    'kubelet-preferred-address-types':
+        'InternalIP,Hostname,InternalDNS,ExternalDNS,ExternalIP',
+    'etcd-cafile': etcd_ca_path,
+    'etcd-keyfile': etcd_key_path,
+    'etcd-certfile': etcd_cert_path,
+    'audit-log-path': audit_root + '/audit.log',
+    'audit-log-maxsize': '100',
+    'audit-log-maxbackup': '9',
+}
+
+# kube-apiserver options for the aggregation layer when metrics are enabled
+apiserver_metrics_opts = {
+    'requestheader-client-ca-file': ca_crt_file,
+    'requestheader-allowed-names': 'system:kube-apiserver',
+    'requestheader-extra-headers-prefix': 'X-Remote-Extra-',
+    'requestheader-group-headers': 'X-Remote-Group',
+    'requestheader-username-headers': 'X-Remote-User',
+    'proxy-client-cert-file': client_crt_file,
+    'proxy-client-key-file': client_key_file,
+    'enable-aggregator-routing': 'true',
+    'client-ca-file': ca_crt_file,
+}
+
+controller_manager_static_opts = {
+    # Default to 3 minute resync. TODO: Make this configurable?
+    'min-resync-period': '3m',
+    'v': '2',
+    'root-ca-file': ca_crt_file,
+    'logtostderr': 'true',
+    'master': 'http://127.0.0.1:8080',
+    'service-account-private-key-file': '/root/cdk/serviceaccount.key',
+    'tls-cert-file': server_crt_file,
+    'tls-private-key-file': server_key_file,
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _db():
+    ''' Return the unit's key/value store, opening it on first use. '''
+    return unitdata.kv()
+
+
+@functools.lru_cache(maxsize=1)
+def kubectl_cache_arg():
+    ''' Return the kubectl argument selecting the root-only cache directory,
+    creating it first if needed. /run is emptied on reboot. '''
+    os.makedirs(kubectl_cache_dir, mode=0o700, exist_ok=True)
+    os.chmod(os.path.dirname(kubectl_cache_dir), 0o700)
+    os.chmod(kubectl_cache_dir, 0o700)
+    return '--cache-dir=' + kubectl_cache_dir
+
+
+@functools.lru_cache(maxsize=8)
+def get_version(bin_name):
+    ''' Return the version tuple of a Kubernetes binary. The result is cached
+    for the rest of the hook; call get_version.cache_clear() after the snaps
+    are installed or refreshed. kube-apiserver's version is read through
+    apiserver_version_string, which survives across hooks. '''
+    if bin_name != 'kube-apiserver':
+        return kubernetes_common.get_version(bin_name)
+    version_string = apiserver_version_string()
+    return tuple(int(q) for q in version_number_re.findall(version_string)[:3])
+
+
+# Endpoints looked up during this hook, keyed by flag.
+_endpoint_cache = {}
+
+
+def _endpoint_from_flag(flag):
+    ''' Like endpoint_from_flag, but reuses the endpoint found earlier in
+    this hook for as long as the flag remains set. '''
+    if not is_flag_set(flag):
+        return None
+    endpoint = _endpoint_cache.get(flag)
+    if endpoint is None:
+        endpoint = endpoint_from_flag(flag)
+        if endpoint is not None:
+            _endpoint_cache[flag] = endpoint
+    return endpoint
+
+
+@functools.lru_cache(maxsize=1)
+def _leader_settings():
+    ''' Return all leadership settings, read once per hook. '''
+    return leader_get() or {}
+
+
+def leader_getc(attribute):
+    ''' Like leader_get, but served from a single read of the leadership
+    settings. Writes must go through leader_setc so the copy is dropped. '''
+    return _leader_settings().get(attribute)
+
+
+def leader_setc(*args, **kwargs):
+    ''' leader_set, then forget the cached leadership settings. '''
+    leader_set(*args, **kwargs)
+    _leader_settings.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _resource_checksum(resource):
+    ''' Return the layer's checksum of a snap resource. Attached resources do
+    not change during a hook, so each one is only hashed once. '''
+    return kubernetes_common.calculate_resource_checksum(resource)
+
+
+def _calculate_and_store_resource_checksums(checksum_prefix, snap_resources):
+    for resource in snap_resources:
+        _db().set(checksum_prefix + resource, _resource_checksum(resource))
+
+
+def _check_resources_for_upgrade_needed(checksum_prefix, snap_resources):
+    hookenv.status_set('maintenance', 'Checking resources')
+    for resource in snap_resources:
+        old_checksum = _db().get(checksum_prefix + resource)
+        if _resource_checksum(resource) != old_checksum:
+            return True
+    return False
 
 
 def set_upgrade_needed(forced=False):
@@ -126,14 +396,14 @@ def channel_changed():
 
 def service_cidr():
     ''' Return the charm's service-cidr config '''
-    frozen_cidr = db.get('kubernetes-master.service-cidr')
+    frozen_cidr = _db().get('kubernetes-master.service-cidr')
     return frozen_cidr or hookenv.config('service-cidr')
 
 
 def freeze_service_cidr():
     ''' Freeze the service CIDR. Once the apiserver has started, we can no
     longer safely change this value. '''
-    db.set('kubernetes-master.service-cidr', service_cidr())
+    _db().set('kubernetes-master.service-cidr', service_cidr())
 
 
 def maybe_install_kube_proxy():
@@ -141,7 +411,8 @@ def maybe_install_kube_proxy():
         channel = hookenv.config('channel')
         hookenv.status_set('maintenance', 'Installing kube-proxy snap')
         snap.install('kube-proxy', channel=channel, classic=True)
-        calculate_and_store_resource_checksums(checksum_prefix, snap_resources)
+        _calculate_and_store_resource_checksums(checksum_prefix,
+                                                snap_resources)
 
 
 @hook('upgrade-charm')
@@ -173,7 +444,7 @@ def check_for_upgrade_needed():
     set_state('reconfigure.authentication.setup')
     remove_state('authentication.setup')
 
-    if not db.get('snap.resources.fingerprint.initialised'):
+    if not _db().get('snap.resources.fingerprint.initialised'):
         # We are here on an upgrade from non-rolling master
         # Since this upgrade might also include resource updates eg
         # juju upgrade-charm kubernetes-master --resource kube-any=my.snap
@@ -182,51 +453,53 @@ def check_for_upgrade_needed():
         set_upgrade_needed(forced=True)
 
     migrate_resource_checksums(checksum_prefix, snap_resources)
-    if check_resources_for_upgrade_needed(checksum_prefix, snap_resources):
+    if _check_resources_for_upgrade_needed(checksum_prefix, snap_resources):
         set_upgrade_needed()
 
     # Set the auto storage backend to etcd2.
-    auto_storage_backend = leader_get('auto_storage_backend')
+    auto_storage_backend = leader_getc('auto_storage_backend')
     is_leader = is_state('leadership.is_leader')
     if not auto_storage_backend and is_leader:
-        leader_set(auto_storage_backend='etcd2')
+        leader_setc(auto_storage_backend='etcd2')
 
-    if is_leader and not leader_get('auto_dns_provider'):
+    if is_leader and not leader_getc('auto_dns_provider'):
         was_kube_dns = hookenv.config().previous('enable-kube-dns')
         if was_kube_dns is True:
-            leader_set(auto_dns_provider='kube-dns')
+            leader_setc(auto_dns_provider='kube-dns')
         elif was_kube_dns is False:
-            leader_set(auto_dns_provider='none')
+            leader_setc(auto_dns_provider='none')
+
 
+def add_rbac_roles(preserve=False):
+    '''Update the known_tokens file with proper groups.
 
-def add_rbac_roles():
-    '''Update the known_tokens file with proper groups.'''
+    param: preserve - keep a copy of the original file in
+                      known_tokens.csv.backup'''
 
     tokens_fname = '/root/cdk/known_tokens.csv'
     tokens_backup_fname = '/root/cdk/known_tokens.csv.backup'
-    move(tokens_fname, tokens_backup_fname)
-    with open(tokens_fname, 'w') as ftokens:
-        with open(tokens_backup_fname, 'r') as stream:
-            for line in stream:
-                record = line.strip().split(',')
-                # token, username, user, groups
-                if record[2] == 'admin' and len(record) == 3:
-                    towrite = '{0},{1},{2},"{3}"\n'.format(record[0],
-                                                           record[1],
-                                                           record[2],
-                                                           'system:masters')
-                    ftokens.write(towrite)
-                    continue
-                if record[2] == 'kube_proxy':
-                    towrite = '{0},{1},{2}\n'.format(record[0],
-                                                     'system:kube-proxy',
-                                                     'kube-proxy')
-                    ftokens.write(towrite)
-                    continue
-                if record[2] == 'kubelet' and record[1] == 'kubelet':
-                    continue
-
-                ftokens.write('{}'.format(line))
+    if preserve:
+        copyfile(tokens_fname, tokens_backup_fname)
+    with open(tokens_fname, 'r', newline='') as stream, \
+            tempfile.NamedTemporaryFile('w', dir='/root/cdk', newline='',
+                                        delete=False) as ftokens:
+        writer = csv.writer(ftokens, lineterminator='\n')
+        for record in csv.reader(stream):
+            if not record:
+                continue
+            # token, username, user, groups
+            if record[2] == 'admin' and len(record) == 3:
+                writer.writerow(record + ['system:masters'])
+                continue
+            if record[2] == 'kube_proxy':
+                writer.writerow([record[0], 'system:kube-proxy', 'kube-proxy'])
+                continue
+            if record[2] == 'kubelet' and record[1] == 'kubelet':
+                continue
+
+            writer.writerow(record)
+    shutil.copymode(tokens_fname, ftokens.name)
+    os.replace(ftokens.name, tokens_fname)
 
 
 def rename_file_idempotent(source, destination):
@@ -245,8 +518,12 @@ def migrate_from_pre_snaps():
     pre_snap_services = ['kube-apiserver',
                          'kube-controller-manager',
                          'kube-scheduler']
-    for service in pre_snap_services:
-        service_stop(service)
+    units = ['{}.service'.format(s) for s in pre_snap_services]
+    try:
+        check_call(['systemctl', 'stop'] + units)
+    except CalledProcessError:
+        # Some or all of the services may not exist anymore; that's fine.
+        pass
 
     # rename auth files
     os.makedirs('/root/cdk', exist_ok=True)
@@ -274,10 +551,14 @@ def migrate_from_pre_snaps():
         "/etc/kubernetes"
     ]
     for file in files:
-        if os.path.isdir(file):
+        try:
+            mode = os.stat(file).st_mode
+        except FileNotFoundError:
+            continue
+        if stat.S_ISDIR(mode):
             hookenv.log("Removing directory: " + file)
             shutil.rmtree(file)
-        elif os.path.isfile(file):
+        elif stat.S_ISREG(mode):
             hookenv.log("Removing file: " + file)
             os.remove(file)
 
@@ -291,6 +572,13 @@ def do_upgrade():
 
 def install_snaps():
     channel = hookenv.config('channel')
+    # Fetch attached snap resources concurrently so their downloads overlap;
+    # snap.install() below then finds them in the agent's resource cache.
+    # The installs themselves stay sequential because they set reactive
+    # flags, and the unitdata store cannot be used from other threads.
+    hookenv.status_set('maintenance', 'Fetching snap resources')
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(hookenv.resource_get, snap_resources))
     hookenv.status_set('maintenance', 'Installing core snap')
     snap.install('core')
     hookenv.status_set('maintenance', 'Installing kubectl snap')
@@ -306,8 +594,9 @@ def install_snaps():
     snap.install('cdk-addons', channel=channel)
     hookenv.status_set('maintenance', 'Installing kube-proxy snap')
     snap.install('kube-proxy', channel=channel, classic=True)
-    calculate_and_store_resource_checksums(checksum_prefix, snap_resources)
-    db.set('snap.resources.fingerprint.initialised', True)
+    _calculate_and_store_resource_checksums(checksum_prefix, snap_resources)
+    _db().set('snap.resources.fingerprint.initialised', True)
+    get_version.cache_clear()
     set_state('kubernetes-master.snaps.installed')
     remove_state('kubernetes-master.components.started')
 
@@ -369,17 +658,24 @@ def setup_leader_authentication():
             check_call(cmd)
         remove_state('reconfigure.authentication.setup')
 
-    # read service account key for syndication
+    # read service account key for syndication, skipping files that have
+    # not changed since we last broadcast them
     leader_data = {}
+    stats = {}
     for f in [known_tokens, basic_auth, service_key]:
-        with open(f, 'r') as fp:
-            leader_data[f] = fp.read()
+        st = os.stat(f)
+        stats[f] = [st.st_size, st.st_mtime_ns]
+        if _db().get('kubernetes-master.leader-auth-stat.' + f) != stats[f]:
+            leader_data[f] = Path(f).read_text()
 
     # this is slightly opaque, but we are sending file contents under its file
     # path as a key.
     # eg:
     # {'/root/cdk/serviceaccount.key': 'RSA:2471731...'}
-    leader_set(leader_data)
+    if leader_data:
+        leader_setc(leader_data)
+        for f in leader_data:
+            _db().set('kubernetes-master.leader-auth-stat.' + f, stats[f])
     remove_state('kubernetes-master.components.started')
     set_state('authentication.setup')
 
@@ -398,7 +694,10 @@ def setup_non_leader_authentication():
         # the keys were not retrieved. Non-leaders have to retry.
         return
 
-    if not any_file_changed(keys) and is_state('authentication.setup'):
+    digest = _leader_keys_digest(keys)
+    changed = digest != _db().get('kubernetes-master.auth-digest')
+    _db().set('kubernetes-master.auth-digest', digest)
+    if not changed and is_state('authentication.setup'):
         # No change detected and we have already setup the authentication
         return
 
@@ -408,6 +707,16 @@ def setup_non_leader_authentication():
     set_state('authentication.setup')
 
 
+def _leader_keys_digest(keys):
+    '''Return a single digest over the leader's broadcast contents of the
+    given files, which is what get_keys_from_leader writes out.'''
+    digest = hashlib.sha256()
+    for key in sorted(keys):
+        digest.update(key.encode('utf-8') + b'\0')
+        digest.update(leader_getc(key).encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
 def get_keys_from_leader(keys, overwrite_local=False):
     """
     Gets the broadcasted keys from the leader and stores them in
@@ -427,15 +736,14 @@ def get_keys_from_leader(keys, overwrite_local=False):
         # If the path does not exist, assume we need it
         if not os.path.exists(k) or overwrite_local:
             # Fetch data from leadership broadcast
-            contents = leader_get(k)
+            contents = leader_getc(k)
             # Default to logging the warning and wait for leader data to be set
             if contents is None:
                 hookenv.log('Missing content for file {}'.format(k))
                 return False
-            # Write out the file and move on to the next item
-            with open(k, 'w+') as fp:
-                fp.write(contents)
-                fp.write('\n')
+            # Write out the file and move on to the next item. Leave it
+            # alone if it already matches, so its mtime stays put.
+            write_if_changed(k, contents + '\n')
 
     return True
 
@@ -443,33 +751,58 @@ def get_keys_from_leader(keys, overwrite_local=False):
 @when('kubernetes-master.snaps.installed')
 def set_app_version():
     ''' Declare the application version to juju '''
-    version = check_output(['kube-apiserver', '--version'])
-    hookenv.application_version_set(version.split(b' v')[-1].rstrip())
+    version = apiserver_version_string()
+    hookenv.application_version_set(version.split(' v')[-1].rstrip())
 
 
 @hookenv.atexit
 def set_final_status():
     ''' Set the final status of the charm as we leave hook execution '''
+    # Flags don't change while we work out the status; read them once.
+    flags = {name: is_flag_set(name) for name in (
+        'authentication.setup',
+        'cdk-addons.configured',
+        'ceph-client.connected',
+        'ceph-storage.available',
+        'cni.available',
+        'endpoint.azure.joined',
+        'endpoint.vsphere.joined',
+        'kube-api-endpoint.available',
+        'kube-control.connected',
+        'kube-control.gpu.available',
+        'kubernetes-master.ceph.configured',
+        'kubernetes-master.cloud.blocked',
+        'kubernetes-master.cloud.pending',
+        'kubernetes-master.components.started',
+        'kubernetes-master.gpu.enabled',
+        'kubernetes-master.privileged',
+        'kubernetes-master.secure-storage.created',
+        'kubernetes-master.secure-storage.failed',
+        'kubernetes-master.upgrade-needed',
+        'kubernetes-master.upgrade-specified',
+        'leadership.is_leader',
+    )}
+
     try:
         goal_state = hookenv.goal_state()
     except NotImplementedError:
         goal_state = {}
 
-    if is_flag_set('kubernetes-master.secure-storage.failed'):
+    if flags['kubernetes-master.secure-storage.failed']:
         hookenv.status_set('blocked',
                            'Failed to configure encryption; '
                            'secrets are unencrypted or inaccessible')
         return
-    elif is_flag_set('kubernetes-master.secure-storage.created'):
+    elif flags['kubernetes-master.secure-storage.created']:
         if not encryption_config_path().exists():
             hookenv.status_set('blocked',
                                'VaultLocker containing encryption config '
                                'unavailable')
             return
 
-    vsphere_joined = is_state('endpoint.vsphere.joined')
-    azure_joined = is_state('endpoint.azure.joined')
-    cloud_blocked = is_state('kubernetes-master.cloud.blocked')
+    vsphere_joined = flags['endpoint.vsphere.joined']
+    azure_joined = flags['endpoint.azure.joined']
+    cloud_blocked = flags['kubernetes-master.cloud.blocked']
     if vsphere_joined and cloud_blocked:
         hookenv.status_set('blocked',
                            'vSphere integration requires K8s 1.12 or greater')
@@ -479,11 +812,11 @@ def set_final_status():
                            'Azure integration requires K8s 1.11 or greater')
         return
 
-    if is_state('kubernetes-master.cloud.pending'):
+    if flags['kubernetes-master.cloud.pending']:
         hookenv.status_set('waiting', 'Waiting for cloud integration')
         return
 
-    if not is_state('kube-api-endpoint.available'):
+    if not flags['kube-api-endpoint.available']:
         if 'kube-api-endpoint' in goal_state.get('relations', {}):
             status = 'waiting'
         else:
@@ -491,7 +824,7 @@ def set_final_status():
         hookenv.status_set(status, 'Waiting for kube-api-endpoint relation')
         return
 
-    if not is_state('kube-control.connected'):
+    if not flags['kube-control.connected']:
         if 'kube-control' in goal_state.get('relations', {}):
             status = 'waiting'
         else:
@@ -505,8 +838,8 @@ def set_final_status():
         hookenv.status_set('blocked', msg)
         return
 
-    upgrade_needed = is_state('kubernetes-master.upgrade-needed')
-    upgrade_specified = is_state('kubernetes-master.upgrade-specified')
+    upgrade_needed = flags['kubernetes-master.upgrade-needed']
+    upgrade_specified = flags['kubernetes-master.upgrade-specified']
     if upgrade_needed and not upgrade_specified:
         msg = 'Needs manual upgrade, run the upgrade action'
         hookenv.status_set('blocked', msg)
@@ -522,7 +855,7 @@ def set_final_status():
         hookenv.status_set('blocked', msg)
         return
 
-    if is_state('kubernetes-master.components.started'):
+    if flags['kubernetes-master.components.started']:
         # All services should be up and running at this point. Double-check...
         failing_services = master_services_down()
         if len(failing_services) != 0:
@@ -532,7 +865,7 @@ def set_final_status():
     else:
         # if we don't have components starting, we're waiting for that and
         # shouldn't fall through to Kubernetes master running.
-        if (is_state('cni.available')):
+        if flags['cni.available']:
             hookenv.status_set('maintenance',
                                'Waiting for master components to start')
         else:
@@ -542,13 +875,13 @@ def set_final_status():
 
     # Note that after this point, kubernetes-master.components.started is
     # always True.
-    is_leader = is_state('leadership.is_leader')
-    authentication_setup = is_state('authentication.setup')
+    is_leader = flags['leadership.is_leader']
+    authentication_setup = flags['authentication.setup']
     if not is_leader and not authentication_setup:
         hookenv.status_set('waiting', "Waiting on leader's crypto keys.")
         return
 
-    addons_configured = is_state('cdk-addons.configured')
+    addons_configured = flags['cdk-addons.configured']
     if is_leader and not addons_configured:
         hookenv.status_set('waiting', 'Waiting to retry addon deployment')
         return
@@ -570,22 +903,21 @@ def set_final_status():
         hookenv.status_set('active', msg)
         return
 
-    gpu_available = is_state('kube-control.gpu.available')
-    gpu_enabled = is_state('kubernetes-master.gpu.enabled')
+    gpu_available = flags['kube-control.gpu.available']
+    gpu_enabled = flags['kubernetes-master.gpu.enabled']
     if gpu_available and not gpu_enabled:
         msg = 'GPUs available. Set allow-privileged="auto" to enable.'
         hookenv.status_set('active', msg)
         return
 
-    if is_state('ceph-storage.available') and \
-            is_state('ceph-client.connected') and \
-            is_state('kubernetes-master.privileged') and \
-            not is_state('kubernetes-master.ceph.configured'):
+    if flags['ceph-storage.available'] and \
+            flags['ceph-client.connected'] and \
+            flags['kubernetes-master.privileged'] and \
+            not flags['kubernetes-master.ceph.configured']:
 
         ceph_admin = endpoint_from_flag('ceph-storage.available')
 
-        if get_version('kube-apiserver') >= (1, 12) and \
-                not ceph_admin.key():
+        if get_version('kube-apiserver') >= (1, 12) and not ceph_admin.key():
             hookenv.status_set(
                 'waiting', 'Waiting for Ceph to provide a key.')
             return
@@ -597,52 +929,77 @@ def master_services_down():
     """Ensure master services are up and running.
 
     Return: list of failing services"""
-    failing_services = []
-    for service in master_services:
-        daemon = 'snap.{}.daemon'.format(service)
-        if not host.service_running(daemon):
-            failing_services.append(service)
-    return failing_services
+    units = ['snap.{}.daemon'.format(s) for s in master_services]
+    try:
+        output = check_output(['systemctl', 'is-active'] + units)
+    except CalledProcessError as e:
+        # is-active exits non-zero if any of the units is not active
+        output = e.output
+    states = output.decode('UTF-8').splitlines()
+    # treat any unit systemctl didn't report on as down
+    states += ['unknown'] * (len(units) - len(states))
+    return [service for service, state in zip(master_services, states)
+            if state != 'active']
 
 
 def add_systemd_file_limit():
+    '''Write the apiserver file-limit drop-in if it is missing. Returns True
+    if it was written.'''
     directory = '/etc/systemd/system/snap.kube-apiserver.daemon.service.d'
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    os.makedirs(directory, exist_ok=True)
 
     file_name = 'file-limit.conf'
     path = os.path.join(directory, file_name)
-    if not os.path.isfile(path):
-        with open(path, 'w') as f:
-            f.write('[Service]\n')
-            f.write('LimitNOFILE=65535')
+    if os.path.isfile(path):
+        return False
+    with open(path, 'w') as f:
+        f.write('[Service]\n')
+        f.write('LimitNOFILE=65535')
+    return True
+
+
+def get_systemd_version():
+    '''Return the installed systemd version. The version is kept in unitdata
+    and `systemd --version` only runs again when the systemd binary
+    changes.'''
+    mtime = os.stat('/bin/systemd').st_mtime_ns
+    cached = _db().get('kubernetes-master.systemd-version')
+    if cached and cached[1] == mtime:
+        return cached[0]
+
+    cmd = ['systemd', '--version']
+    output = check_output(cmd).decode('UTF-8')
+    line = output.splitlines()[0]
+    words = line.split()
+    assert words[0] == 'systemd'
+    systemd_version = int(words[1])
+    _db().set('kubernetes-master.systemd-version', [systemd_version, mtime])
+    return systemd_version
 
 
 def add_systemd_restart_always():
+    '''Write the always-restart drop-in for each master service. Returns True
+    if any of them changed.'''
     template = 'templates/service-always-restart.systemd-latest.conf'
 
     try:
-        # Get the systemd version
-        cmd = ['systemd', '--version']
-        output = check_output(cmd).decode('UTF-8')
-        line = output.splitlines()[0]
-        words = line.split()
-        assert words[0] == 'systemd'
-        systemd_version = int(words[1])
-
         # Check for old version (for xenial support)
-        if systemd_version < 230:
+        if get_systemd_version() < 230:
             template = 'templates/service-always-restart.systemd-229.conf'
     except Exception:
         traceback.print_exc()
         hookenv.log('Failed to detect systemd version, using latest template',
                     level='ERROR')
 
+    data = Path(template).read_bytes()
+    changed = False
     for service in master_services:
         dest_dir = '/etc/systemd/system/snap.{}.daemon.service.d' \
             .format(service)
         os.makedirs(dest_dir, exist_ok=True)
-        copyfile(template, '{}/always-restart.conf'.format(dest_dir))
+        path = '{}/always-restart.conf'.format(dest_dir)
+        changed = write_if_changed(path, data) or changed
+    return changed
 
 
 def add_systemd_file_watcher():
@@ -659,20 +1016,27 @@ def add_systemd_file_watcher():
     call leader-set to distribute the contents of these files to the
     non-leaders so they can sync their local copies to match.
 
+    Returns True if any of its files changed. The caller reloads systemd
+    and starts the path unit.
+
     """
-    render(
-        'cdk.master.leader.file-watcher.sh',
-        '/usr/local/sbin/cdk.master.leader.file-watcher.sh',
-        {}, perms=0o777)
-    render(
-        'cdk.master.leader.file-watcher.service',
-        '/etc/systemd/system/cdk.master.leader.file-watcher.service',
-        {'unit': hookenv.local_unit()}, perms=0o644)
-    render(
-        'cdk.master.leader.file-watcher.path',
-        '/etc/systemd/system/cdk.master.leader.file-watcher.path',
-        {}, perms=0o644)
-    service_resume('cdk.master.leader.file-watcher.path')
+    files = (
+        ('cdk.master.leader.file-watcher.sh',
+         '/usr/local/sbin/cdk.master.leader.file-watcher.sh',
+         {}, 0o777),
+        ('cdk.master.leader.file-watcher.service',
+         '/etc/systemd/system/cdk.master.leader.file-watcher.service',
+         {'unit': hookenv.local_unit()}, 0o644),
+        ('cdk.master.leader.file-watcher.path',
+         '/etc/systemd/system/cdk.master.leader.file-watcher.path',
+         {}, 0o644),
+    )
+    changed = False
+    for source, target, context, perms in files:
+        changed = write_if_changed(target, render(source, None, context)) \
+            or changed
+        os.chmod(target, perms)
+    return changed
 
 
 @when('etcd.available', 'tls_client.certs.saved',
@@ -700,12 +1064,16 @@ def start_master():
     # https://github.com/kubernetes/kubernetes/issues/43461
     handle_etcd_relation(etcd)
 
-    # Set up additional systemd services
-    add_systemd_restart_always()
-    add_systemd_file_limit()
-    add_systemd_file_watcher()
-    add_systemd_iptables_patch()
-    check_call(['systemctl', 'daemon-reload'])
+    # Set up additional systemd services. daemon-reload re-parses every
+    # unit on the system; only do it when a unit or drop-in changed.
+    changed = [add_systemd_restart_always(),
+               add_systemd_file_limit(),
+               add_systemd_file_watcher(),
+               add_systemd_iptables_patch()]
+    if any(changed):
+        check_call(['systemctl', 'daemon-reload'])
+    service_resume('cdk.master.leader.file-watcher.path')
+    service_resume('kube-proxy-iptables-fix.service')
 
     # Add CLI options to all components
     configure_apiserver(etcd.get_connection_string())
@@ -733,8 +1101,8 @@ def certs_changed():
 def ca_written():
     clear_flag('kubernetes-master.components.started')
     if is_state('leadership.is_leader'):
-        if leader_get('kubernetes-master-addons-ca-in-use'):
-            leader_set({'kubernetes-master-addons-restart-for-ca': True})
+        if leader_getc('kubernetes-master-addons-ca-in-use'):
+            leader_setc({'kubernetes-master-addons-restart-for-ca': True})
     clear_flag('tls_client.ca.written')
 
 
@@ -760,13 +1128,13 @@ def etcd_data_change(etcd):
 
     # We are the leader and the auto_storage_backend is not set meaning
     # this is the first time we connect to etcd.
-    auto_storage_backend = leader_get('auto_storage_backend')
+    auto_storage_backend = leader_getc('auto_storage_backend')
     is_leader = is_state('leadership.is_leader')
     if is_leader and not auto_storage_backend:
         if etcd.get_version().startswith('3.'):
-            leader_set(auto_storage_backend='etcd3')
+            leader_setc(auto_storage_backend='etcd3')
         else:
-            leader_set(auto_storage_backend='etcd2')
+            leader_setc(auto_storage_backend='etcd2')
 
 
 @when('kube-control.connected')
@@ -795,19 +1163,14 @@ def send_cluster_dns_detail(kube_control):
 @when('leadership.is_leader')
 def create_service_configs(kube_control):
     """Create the users for kubelet"""
-    should_restart = False
+    # read the token file once and write any new tokens in one go
+    tokens = load_tokens()
+    new_tokens = []
     # generate the username/pass for the requesting unit
-    proxy_token = get_token('system:kube-proxy')
-    if not proxy_token:
-        setup_tokens(None, 'system:kube-proxy', 'kube-proxy')
-        proxy_token = get_token('system:kube-proxy')
-        should_restart = True
-
-    client_token = get_token('admin')
-    if not client_token:
-        setup_tokens(None, 'admin', 'admin', "system:masters")
-        client_token = get_token('admin')
-        should_restart = True
+    proxy_token = ensure_token('system:kube-proxy', 'kube-proxy',
+                               tokens=tokens, pending=new_tokens)
+    client_token = ensure_token('admin', 'admin', "system:masters",
+                                tokens=tokens, pending=new_tokens)
 
     requests = kube_control.auth_user()
     for request in requests:
@@ -815,19 +1178,17 @@ def create_service_configs(kube_control):
         group = request[1]['group']
         if not username or not group:
             continue
-        kubelet_token = get_token(username)
-        if not kubelet_token:
-            # Usernames have to be in the form of system:node:<nodeName>
-            userid = "kubelet-{}".format(request[0].split('/')[1])
-            setup_tokens(None, username, userid, group)
-            kubelet_token = get_token(username)
-            should_restart = True
+        # Usernames have to be in the form of system:node:<nodeName>
+        userid = "kubelet-{}".format(request[0].split('/')[1])
+        kubelet_token = ensure_token(username, userid, group,
+                                     tokens=tokens, pending=new_tokens)
         kube_control.sign_auth_request(request[0], username,
                                        kubelet_token, proxy_token,
                                        client_token)
 
-    if should_restart:
-        service_restart('snap.kube-apiserver.daemon')
+    if new_tokens:
+        append_tokens(new_tokens)
+        restart_service('kube-apiserver')
         remove_state('authentication.setup')
 
 
@@ -835,7 +1196,7 @@ def create_service_configs(kube_control):
 def push_service_data():
     ''' Send configuration to the load balancer, and close access to the
     public interface '''
-    kube_api = endpoint_from_flag('kube-api-endpoint.available')
+    kube_api = _endpoint_from_flag('kube-api-endpoint.available')
 
     # Note that we do not need to worry about the loadbalancer case because
     # the worker charm will be related to the loadbalancer in that case and
@@ -844,19 +1205,27 @@ def push_service_data():
     # if the user gave us IPs for the load balancer, assume they know
     # what they are talking about and use that instead of our information.
     address = None
-    forced_lb_ips = hookenv.config('loadbalancer-ips').split()
-    hacluster = endpoint_from_flag('ha.connected')
+    forced_lb_ips = get_forced_lb_ips()
+    hacluster = _endpoint_from_flag('ha.connected')
     if forced_lb_ips:
-        address = forced_lb_ips
+        address = list(forced_lb_ips)
     elif hacluster:
-        vips = hookenv.config('ha-cluster-vip').split()
-        dns_record = hookenv.config('ha-cluster-dns')
+        vips, dns_record = get_hacluster_config()
         if vips:
             # each worker unit will pick one based on unit number
-            address = vips
+            address = list(vips)
         elif dns_record:
             address = dns_record
 
+    # Only touch the relation when the advertised address changes or a new
+    # relation appears; this runs on every hook and on hacluster changes.
+    # Without an address, configure() publishes our ingress address.
+    if not data_changed('kube-api-endpoint-address',
+                        [address,
+                         get_ingress_address('kube-api-endpoint'),
+                         hookenv.relation_ids('kube-api-endpoint')]):
+        return
+
     if address:
         kube_api.configure(6443, address, address)
     else:
@@ -867,10 +1236,12 @@ def push_service_data():
 def send_data():
     '''Send the data that is required to create a server certificate for
     this server.'''
-    kube_api_endpoint = endpoint_from_flag('kube-api-endpoint.available')
+    config = hookenv.config()
+    kube_api_endpoint = _endpoint_from_flag('kube-api-endpoint.available')
 
     # Use the public ip of this unit as the Common Name for the certificate.
-    common_name = hookenv.unit_public_ip()
+    public_ip = hookenv.unit_public_ip()
+    common_name = public_ip
 
     # Get the SDN gateway based on the cidr address.
     kubernetes_service_ip = get_kubernetes_service_ip()
@@ -878,52 +1249,54 @@ def send_data():
     # Get ingress address
     ingress_ip = get_ingress_address(kube_api_endpoint.endpoint_name)
 
-    domain = hookenv.config('dns_domain')
+    hostname, fqdn = get_host_identity()
+    domain = config.get('dns_domain')
     # Create SANs that the tls layer will add to the server cert.
-    sans = [
-        hookenv.unit_public_ip(),
+    sans = {
+        public_ip,
         ingress_ip,
-        socket.gethostname(),
-        socket.getfqdn(),
+        hostname,
+        fqdn,
         kubernetes_service_ip,
-        'kubernetes',
-        'kubernetes.{0}'.format(domain),
-        'kubernetes.default',
-        'kubernetes.default.svc',
-        'kubernetes.default.svc.{0}'.format(domain)
-    ]
+    }
+    sans.update(kubernetes_sans)
+    sans.update(get_domain_sans(domain))
 
     # if the user gave us IPs for the load balancer, assume they know
     # what they are talking about and use that instead of our information.
-    forced_lb_ips = hookenv.config('loadbalancer-ips').split()
+    forced_lb_ips = get_forced_lb_ips()
     if forced_lb_ips:
-        sans.extend(forced_lb_ips)
+        sans.update(forced_lb_ips)
     else:
-        loadbalancer = endpoint_from_flag('loadbalancer.available')
+        loadbalancer = _endpoint_from_flag('loadbalancer.available')
         # we don't use get_hacluster_ip_or_hostname only here because
         # we want the cert to be valid for all the vips
-        hacluster = endpoint_from_flag('ha.connected')
+        hacluster = _endpoint_from_flag('ha.connected')
         if hacluster:
-            vips = hookenv.config('ha-cluster-vip').split()
-            dns_record = hookenv.config('ha-cluster-dns')
+            vips, dns_record = get_hacluster_config()
             if vips:
-                sans.extend(vips)
+                sans.update(vips)
             elif dns_record:
-                sans.append(dns_record)
+                sans.add(dns_record)
         elif loadbalancer:
             # Get the list of loadbalancers from the relation object.
             hosts = loadbalancer.get_addresses_ports()
-            sans.extend([host.get('public-address') for host in hosts])
+            sans.update(host.get('public-address') for host in hosts)
 
     # maybe they have extra names they want as SANs
-    extra_sans = hookenv.config('extra_sans')
+    extra_sans = config.get('extra_sans')
     if extra_sans and not extra_sans == "":
-        sans.extend(extra_sans.split())
-
-    # Request a server cert with this information.
-    tls_client.request_server_cert(common_name, sorted(set(sans)),
-                                   crt_path=server_crt_path,
-                                   key_path=server_key_path)
+        sans.update(extra_sans.split())
+
+    # Request a server cert with this information, unless we already did.
+    # The certificates relation ids are included so that a new relation
+    # always gets a request.
+    sans = sorted(sans)
+    cert_request = [common_name, sans, hookenv.relation_ids('certificates')]
+    if data_changed('kube-api-server-cert-request', cert_request):
+        tls_client.request_server_cert(common_name, sans,
+                                       crt_path=server_crt_path,
+                                       key_path=server_key_path)
 
     # Request a client cert for kubelet.
     tls_client.request_client_cert('system:kube-apiserver',
@@ -937,7 +1310,12 @@ def update_certificates():
     # Using the config.changed.extra_sans flag to catch changes.
     # IP changes will take ~5 minutes or so to propagate, but
     # it will update.
-    send_data()
+    # Skip edits that leave the set of names unchanged (reordering,
+    # whitespace or duplicates).
+    extra_sans = hookenv.config('extra_sans') or ''
+    normalized = sorted(set(extra_sans.split()))
+    if data_changed('extra_sans-normalized', normalized):
+        send_data()
     clear_flag('config.changed.extra_sans')
 
 
@@ -947,54 +1325,41 @@ def update_certificates():
 @when('leadership.is_leader')
 def configure_cdk_addons():
     ''' Configure CDK addons '''
+    config = hookenv.config()
     remove_state('cdk-addons.configured')
-    load_gpu_plugin = hookenv.config('enable-nvidia-plugin').lower()
-    gpuEnable = (get_version('kube-apiserver') >= (1, 9) and
+    kube_version = get_version('kube-apiserver')
+    load_gpu_plugin = config.get('enable-nvidia-plugin').lower()
+    gpuEnable = (kube_version >= (1, 9) and
                  load_gpu_plugin == "auto" and
                  is_state('kubernetes-master.gpu.enabled'))
     # addons-registry is deprecated in 1.15, but it should take precedence
     # when configuring the cdk-addons snap until 1.17 is released.
-    registry = hookenv.config('addons-registry')
-    if registry and get_version('kube-apiserver') < (1, 17):
+    registry = config.get('addons-registry')
+    if registry and kube_version < (1, 17):
         hookenv.log('addons-registry is deprecated; use image-registry instead')
     else:
-        registry = hookenv.config('image-registry')
-    dbEnabled = str(hookenv.config('enable-dashboard-addons')).lower()
+        registry = config.get('image-registry')
+    dbEnabled = str(config.get('enable-dashboard-addons')).lower()
     try:
         dnsProvider = get_dns_provider()
     except InvalidDnsProvider:
         hookenv.log(traceback.format_exc())
         return
-    metricsEnabled = str(hookenv.config('enable-metrics')).lower()
-    default_storage = ''
-    dashboard_auth = str(hookenv.config('dashboard-auth')).lower()
-    ceph = {}
-    ceph_ep = endpoint_from_flag('ceph-storage.available')
+    metricsEnabled = str(config.get('enable-metrics')).lower()
+    dashboard_auth = str(config.get('dashboard-auth')).lower()
+    ceph_ep = _endpoint_from_flag('ceph-storage.available')
     if (ceph_ep and ceph_ep.key() and
             is_state('kubernetes-master.ceph.configured') and
-            get_version('kube-apiserver') >= (1, 12)):
-        cephEnabled = "true"
-        b64_ceph_key = base64.b64encode(ceph_ep.key().encode('utf-8'))
-        ceph['admin_key'] = b64_ceph_key.decode('ascii')
-        ceph['kubernetes_key'] = b64_ceph_key.decode('ascii')
-        ceph['mon_hosts'] = ceph_ep.mon_hosts()
-        default_storage = hookenv.config('default-storage')
+            kube_version >= (1, 12)):
+        ceph_opts = _cdk_addons_ceph_opts(ceph_ep, config)
     else:
-        cephEnabled = "false"
+        ceph_opts = cdk_addons_ceph_disabled
 
-    keystone = {}
-    ks = endpoint_from_flag('keystone-credentials.available.auth')
+    ks = _endpoint_from_flag('keystone-credentials.available.auth')
     if ks:
-        keystoneEnabled = "true"
-        keystone['cert'] = '/root/cdk/server.crt'
-        keystone['key'] = '/root/cdk/server.key'
-        keystone['url'] = '{}://{}:{}/v{}'.format(ks.credentials_protocol(),
-                                                  ks.credentials_host(),
-                                                  ks.credentials_port(),
-                                                  ks.api_version())
-        keystone['keystone-ca'] = hookenv.config('keystone-ssl-ca')
+        keystone_opts = _cdk_addons_keystone_opts(ks, config)
     else:
-        keystoneEnabled = "false"
+        keystone_opts = cdk_addons_keystone_disabled
 
     if dashboard_auth == 'auto':
         if ks:
@@ -1002,71 +1367,183 @@ def configure_cdk_addons():
         else:
             dashboard_auth = 'basic'
 
-    args = [
-        'arch=' + arch(),
-        'dns-ip=' + get_deprecated_dns_ip(),
-        'dns-domain=' + hookenv.config('dns_domain'),
-        'registry=' + registry,
-        'enable-dashboard=' + dbEnabled,
-        'enable-metrics=' + metricsEnabled,
-        'enable-gpu=' + str(gpuEnable).lower(),
-        'enable-ceph=' + cephEnabled,
-        'ceph-admin-key=' + (ceph.get('admin_key', '')),
-        'ceph-kubernetes-key=' + (ceph.get('admin_key', '')),
-        'ceph-mon-hosts="' + (ceph.get('mon_hosts', '')) + '"',
-        'default-storage=' + default_storage,
-        'enable-keystone=' + keystoneEnabled,
-        'keystone-cert-file=' + keystone.get('cert', ''),
-        'keystone-key-file=' + keystone.get('key', ''),
-        'keystone-server-url=' + keystone.get('url', ''),
-        'keystone-server-ca=' + keystone.get('keystone-ca', ''),
-        'dashboard-auth=' + dashboard_auth
+    addon_opts = [
+        ('arch', arch()),
+        ('dns-ip', get_deprecated_dns_ip()),
+        ('dns-domain', config.get('dns_domain')),
+        ('registry', registry),
+        ('enable-dashboard', dbEnabled),
+        ('enable-metrics', metricsEnabled),
+        ('enable-gpu', str(gpuEnable).lower()),
+        ('dashboard-auth', dashboard_auth),
     ]
-    if get_version('kube-apiserver') >= (1, 14):
-        args.append('dns-provider=' + dnsProvider)
+    addon_opts.extend(sorted(ceph_opts.items()))
+    addon_opts.extend(sorted(keystone_opts.items()))
+    if kube_version >= (1, 14):
+        addon_opts.append(('dns-provider', dnsProvider))
     else:
         enableKubeDNS = dnsProvider == 'kube-dns'
-        args.append('enable-kube-dns=' + str(enableKubeDNS).lower())
-    check_call(['snap', 'set', 'cdk-addons'] + args)
+        addon_opts.append(('enable-kube-dns', str(enableKubeDNS).lower()))
+    args = ['{}={}'.format(key, value) for key, value in addon_opts]
+    if data_changed('cdk-addons-args', args):
+        snap_set('cdk-addons', addon_opts)
     if not addons_ready():
         remove_state('cdk-addons.configured')
         return
 
     set_state('cdk-addons.configured')
-    leader_set({'kubernetes-master-addons-ca-in-use': True})
+    leader_setc({'kubernetes-master-addons-ca-in-use': True})
     if ks:
-        leader_set({'keystone-cdk-addons-configured': True})
+        leader_setc({'keystone-cdk-addons-configured': True})
     else:
-        leader_set({'keystone-cdk-addons-configured': None})
+        leader_setc({'keystone-cdk-addons-configured': None})
+
+
+def _cdk_addons_ceph_opts(ceph_ep, config):
+    ''' Return the cdk-addons options for an available ceph relation. '''
+    b64_ceph_key = base64.b64encode(ceph_ep.key().encode('utf-8'))
+    b64_ceph_key = b64_ceph_key.decode('ascii')
+    return {
+        'enable-ceph': 'true',
+        'ceph-admin-key': b64_ceph_key,
+        'ceph-kubernetes-key': b64_ceph_key,
+        'ceph-mon-hosts': '"{}"'.format(ceph_ep.mon_hosts()),
+        'default-storage': config.get('default-storage'),
+    }
+
+
+def _cdk_addons_keystone_opts(ks, config):
+    ''' Return the cdk-addons options for an available keystone relation. '''
+    return {
+        'enable-keystone': 'true',
+        'keystone-cert-file': '/root/cdk/server.crt',
+        'keystone-key-file': '/root/cdk/server.key',
+        'keystone-server-url': '{}://{}:{}/v{}'.format(
+            ks.credentials_protocol(), ks.credentials_host(),
+            ks.credentials_port(), ks.api_version()),
+        'keystone-server-ca': config.get('keystone-ssl-ca'),
+    }
+
+
+class _SnapdConnection(http.client.HTTPConnection):
+    '''HTTP connection to the snapd REST API over its unix socket.'''
+
+    def __init__(self, timeout=30):
+        super().__init__('localhost', timeout=timeout)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(snapd_socket)
+
+
+def _snapd_request(conn, method, path, body=None):
+    headers = {}
+    if body is not None:
+        body = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    result = json.loads(response.read().decode('utf-8'))
+    if result.get('type') == 'error':
+        raise OSError('snapd {} {}: {}'.format(
+            method, path, result['result'].get('message')))
+    return result
+
+
+class SnapdChangeError(Exception):
+    '''snapd accepted a change but it failed or did not finish in time.'''
+    pass
+
+
+def _snapd_set(snap_name, options, timeout=300):
+    '''Set snap options through snapd and wait up to timeout seconds for the
+    configure hook. Once snapd has accepted the change, any failure raises
+    SnapdChangeError.'''
+    conf = {}
+    for key, value in options:
+        # Same value parsing as the snap set command line.
+        try:
+            conf[key] = json.loads(value)
+        except ValueError:
+            conf[key] = value
+    conn = _SnapdConnection()
+    try:
+        result = _snapd_request(conn, 'PUT',
+                                '/v2/snaps/{}/conf'.format(snap_name), conf)
+        change_id = result['change']
+        path = '/v2/changes/{}'.format(change_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                change = _snapd_request(conn, 'GET', path)['result']
+            except (OSError, ValueError, KeyError,
+                    http.client.HTTPException) as e:
+                raise SnapdChangeError('snapd change {}: {}'.format(
+                    change_id, e))
+            if change.get('ready'):
+                break
+            if time.monotonic() > deadline:
+                raise SnapdChangeError(
+                    'snapd change {} not ready after {}s'.format(
+                        change_id, timeout))
+            time.sleep(0.1)
+    finally:
+        conn.close()
+    if change.get('status') != 'Done':
+        raise SnapdChangeError('snapd change {} {}: {}'.format(
+            change_id, change.get('status'), change.get('err')))
+
+
+def snap_set(snap_name, options):
+    '''Set options on a snap from a list of (key, value) pairs, talking
+    to snapd directly and falling back to the snap command if the snapd
+    API cannot be used. A change that snapd accepted but that failed or
+    timed out raises SnapdChangeError.'''
+    try:
+        _snapd_set(snap_name, options)
+    except (OSError, ValueError, KeyError, http.client.HTTPException):
+        hookenv.log('snapd API unavailable, using snap set')
+        args = ['{}={}'.format(key, value) for key, value in options]
+        check_call(['snap', 'set', snap_name] + args)
 
 
-@retry(times=3, delay_secs=20)
 def addons_ready():
     """
     Test if the add ons got installed
 
+    Retries with an increasing, jittered delay so that quickly-ready systems
+    aren't held up by a fixed wait.
+
     Returns: True is the addons got applied
 
     """
-    try:
-        check_call(['cdk-addons.apply'])
-        return True
-    except CalledProcessError:
-        hookenv.log("Addons are not ready yet.")
+    if not os.path.isfile('/snap/bin/cdk-addons.apply'):
+        hookenv.log('cdk-addons.apply not found, cannot apply addons.')
         return False
 
+    for delay in (1, 4, 15, None):
+        try:
+            check_call(['cdk-addons.apply'])
+            return True
+        except CalledProcessError:
+            hookenv.log("Addons are not ready yet.")
+        if delay:
+            time.sleep(delay + random.random())
+    return False
+
 
 @when('loadbalancer.available', 'certificates.ca.available',
       'certificates.client.cert.available', 'authentication.setup')
 def loadbalancer_kubeconfig():
-    loadbalancer = endpoint_from_flag('loadbalancer.available')
+    loadbalancer = _endpoint_from_flag('loadbalancer.available')
     # Get the potential list of loadbalancers from the relation object.
     hosts = loadbalancer.get_addresses_ports()
     # if there is a hacluster relation, use that vip/dns for the kubeconfig
     hacluster_vip = get_hacluster_ip_or_hostname()
     # if the user gave us IPs for the load balancer, assume they know
     # what they are talking about and use that instead of our information.
-    forced_lb_ips = hookenv.config('loadbalancer-ips').split()
+    forced_lb_ips = get_forced_lb_ips()
     if forced_lb_ips:
         address = forced_lb_ips[get_unit_number() % len(forced_lb_ips)]
     else:
@@ -1090,7 +1567,7 @@ def create_self_config():
     '''Create a kubernetes configuration for the master unit.'''
     # if the user gave us IPs for the load balancer, assume they know
     # what they are talking about and use that instead of our information.
-    forced_lb_ips = hookenv.config('loadbalancer-ips').split()
+    forced_lb_ips = get_forced_lb_ips()
     if forced_lb_ips:
         address = forced_lb_ips[get_unit_number() % len(forced_lb_ips)]
     else:
@@ -1115,7 +1592,7 @@ def ceph_state_control():
         'mon_hosts': ceph_admin.mon_hosts(),
         'fsid': ceph_admin.fsid(),
         'auth_supported': ceph_admin.auth(),
-        'hostname': socket.gethostname(),
+        'hostname': get_host_identity()[0],
         'key': ceph_admin.key()
     }
 
@@ -1128,7 +1605,7 @@ def ceph_state_control():
 @when_not('ceph-storage.available')
 def ceph_storage_gone():
     # ceph has left, so clean up
-    reconfigure_apiserver(endpoint_from_flag('etcd.available'))
+    reconfigure_apiserver(_endpoint_from_flag('etcd.available'))
 
     remove_state('kubernetes-master.ceph.configured')
 
@@ -1153,7 +1630,7 @@ def ceph_storage_privilege():
 
     :return: None
     """
-    reconfigure_apiserver(endpoint_from_flag('etcd.available'))
+    reconfigure_apiserver(_endpoint_from_flag('etcd.available'))
 
 
 @when('ceph-client.connected')
@@ -1227,11 +1704,12 @@ def ceph_storage():
             # entry, ensuring our ceph-secret is always reflective of
             # what we have in /etc/ceph assuming we have invoked this
             # anytime that file would change.
+            # Render in memory and feed it to kubectl on stdin so the
+            # secret never touches disk.
             context = {'secret': encoded_key.decode('ascii')}
-            render('ceph-secret.yaml', '/tmp/ceph-secret.yaml', context)
-            cmd = ['kubectl', 'apply', '-f', '/tmp/ceph-secret.yaml']
-            check_call(cmd)
-            os.remove('/tmp/ceph-secret.yaml')
+            secret = render('ceph-secret.yaml', None, context)
+            cmd = ['kubectl', kubectl_cache_arg(), 'apply', '-f', '-']
+            run(cmd, input=secret.encode('utf-8'), check=True)
             set_state('kubernetes-master.ceph.pool.created')
         except:  # NOQA
             # The enlistment in kubernetes failed, return and
@@ -1316,15 +1794,11 @@ def remove_rbac_resources():
 @when_any('config.changed.nagios_context',
           'config.changed.nagios_servicegroups')
 def update_nrpe_config(unused=None):
-    services = (
-        'snap.kube-apiserver.daemon',
-        'snap.kube-controller-manager.daemon',
-        'snap.kube-scheduler.daemon'
-    )
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
-    nrpe.add_init_service_checks(nrpe_setup, services, current_unit)
+    # checks are queued on nrpe_setup and written out in one pass by write()
+    nrpe.add_init_service_checks(nrpe_setup, nrpe_services, current_unit)
     nrpe_setup.write()
 
 
@@ -1333,19 +1807,12 @@ def update_nrpe_config(unused=None):
 def remove_nrpe_config(nagios=None):
     remove_state('nrpe-external-master.initial-config')
 
-    # List of systemd services for which the checks will be removed
-    services = (
-        'snap.kube-apiserver.daemon',
-        'snap.kube-controller-manager.daemon',
-        'snap.kube-scheduler.daemon'
-    )
-
     # The current nrpe-external-master interface doesn't handle a lot of logic,
     # use the charm-helpers code for now.
     hostname = nrpe.get_nagios_hostname()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
 
-    for service in services:
+    for service in nrpe_services:
         nrpe_setup.remove_check(shortname=service)
 
 
@@ -1443,8 +1910,10 @@ def shutdown():
     """ Stop the kubernetes master services
 
     """
-    for service in master_services:
-        service_stop('snap.%s.daemon' % service)
+    # each stop blocks until its daemon exits; stop them concurrently
+    with ThreadPoolExecutor(max_workers=len(master_services)) as executor:
+        list(executor.map(lambda service: service_stop(
+            'snap.%s.daemon' % service), master_services))
 
 
 def build_kubeconfig(server):
@@ -1456,7 +1925,7 @@ def build_kubeconfig(server):
     # Do we have everything we need?
     if ca_exists and client_pass:
         # drop keystone helper script?
-        ks = endpoint_from_flag('keystone-credentials.available.auth')
+        ks = _endpoint_from_flag('keystone-credentials.available.auth')
         if ks:
             script_filename = 'kube-keystone.sh'
             keystone_path = os.path.join(os.sep, 'home', 'ubuntu',
@@ -1476,15 +1945,21 @@ def build_kubeconfig(server):
         # Create the kubeconfig on this system so users can access the cluster.
 
         try:
+            st = os.stat(kubeconfig_path)
+        except FileNotFoundError:
+            pass
+        else:
+            # Only read the file back if it was touched since last time.
+            sig = [st.st_mtime_ns, st.st_size, bool(ks)]
+            if not data_changed('kube-config-sig', sig):
+                return
             with open(kubeconfig_path, 'r') as conf:
                 config_matrix = {
-                    'keystone': ks,
+                    'keystone': bool(ks),
                     'conf': conf.read()
                 }
-                if not data_changed('kube-config-build', config_matrix):
-                    return
-        except FileNotFoundError:
-            pass
+            if not data_changed('kube-config-build', config_matrix):
+                return
 
         hookenv.log('Writing kubeconfig file.')
 
@@ -1497,8 +1972,7 @@ def build_kubeconfig(server):
                               user='admin', password=client_pass)
 
         # Make the config file readable by the ubuntu users so juju scp works.
-        cmd = ['chown', 'ubuntu:ubuntu', kubeconfig_path]
-        check_call(cmd)
+        os.chown(kubeconfig_path, *get_ubuntu_ids())
 
         # make a copy in a location shared by kubernetes-worker
         # and kubernete-master
@@ -1506,47 +1980,71 @@ def build_kubeconfig(server):
                           user='admin', password=client_pass)
 
         # make a kubeconfig for kube-proxy
-        proxy_token = get_token('system:kube-proxy')
-        if not proxy_token:
-            setup_tokens(None, 'system:kube-proxy', 'kube-proxy')
-            proxy_token = get_token('system:kube-proxy')
+        proxy_token = ensure_token('system:kube-proxy', 'kube-proxy')
         create_kubeconfig(kubeproxyconfig_path, server, ca_crt_path,
                           token=proxy_token, user='kube-proxy')
 
 
+@functools.lru_cache(maxsize=1)
+def _split_lb_ips(raw):
+    return tuple(raw.split())
+
+
+def get_forced_lb_ips():
+    '''Return the loadbalancer-ips config option as a tuple of addresses.'''
+    return _split_lb_ips(hookenv.config('loadbalancer-ips'))
+
+
+@functools.lru_cache(maxsize=4)
+def get_domain_sans(domain):
+    '''Return the in-cluster service names that depend on the dns_domain.'''
+    return ('kubernetes.{0}'.format(domain),
+            'kubernetes.default.svc.{0}'.format(domain))
+
+
+@functools.lru_cache(maxsize=1)
+def get_host_identity():
+    '''Return this machine's (hostname, fqdn). getfqdn() may need a DNS
+    lookup, so it is only done once per hook.'''
+    return socket.gethostname(), socket.getfqdn()
+
+
+@functools.lru_cache(maxsize=1)
+def get_ubuntu_ids():
+    '''Return the (uid, gid) of the ubuntu user and group.'''
+    return pwd.getpwnam('ubuntu').pw_uid, grp.getgrnam('ubuntu').gr_gid
+
+
 def get_dns_ip():
     return get_service_ip('kube-dns', namespace='kube-system')
 
 
+@functools.lru_cache(maxsize=4)
+def _service_network_address(cidr):
+    '''Return the network address of the given service CIDR.'''
+    return ipaddress.IPv4Interface(cidr).network.network_address
+
+
 def get_deprecated_dns_ip():
     '''We previously hardcoded the dns ip. This function returns the old
     hardcoded value for use with older versions of cdk_addons.'''
-    interface = ipaddress.IPv4Interface(service_cidr())
-    ip = interface.network.network_address + 10
+    ip = _service_network_address(service_cidr()) + 10
     return ip.exploded
 
 
 def get_kubernetes_service_ip():
     '''Get the IP address for the kubernetes service based on the cidr.'''
-    interface = ipaddress.IPv4Interface(service_cidr())
     # Add .1 at the end of the network
-    ip = interface.network.network_address + 1
+    ip = _service_network_address(service_cidr()) + 1
     return ip.exploded
 
 
 def handle_etcd_relation(reldata):
     ''' Save the client credentials and set appropriate daemon flags when
     etcd declares itself as available'''
-    # Define where the etcd tls files will be kept.
-    etcd_dir = '/root/cdk/etcd'
-
-    # Create paths to the etcd client ca, key, and cert file locations.
-    ca = os.path.join(etcd_dir, 'client-ca.pem')
-    key = os.path.join(etcd_dir, 'client-key.pem')
-    cert = os.path.join(etcd_dir, 'client-cert.pem')
-
     # Save the client credentials (in relation data) to the paths provided.
-    reldata.save_client_credentials(key, cert, ca)
+    reldata.save_client_credentials(etcd_key_path, etcd_cert_path,
+                                    etcd_ca_path)
 
 
 def remove_if_exists(path):
@@ -1556,22 +2054,99 @@ def remove_if_exists(path):
         pass
 
 
+def write_if_changed(path, contents):
+    '''Write contents to path unless the file already holds exactly that.
+    Returns True if the file was written.'''
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+    try:
+        if Path(path).read_bytes() == contents:
+            return False
+    except FileNotFoundError:
+        pass
+    Path(path).write_bytes(contents)
+    return True
+
+
 def write_file_with_autogenerated_header(path, contents):
-    with open(path, 'w') as f:
-        header = '# Autogenerated by kubernetes-master charm'
-        f.write(header + '\n' + contents)
+    header = '# Autogenerated by kubernetes-master charm'
+    return write_if_changed(path, header + '\n' + contents)
 
 
-def configure_apiserver(etcd_connection_string):
-    api_opts = {}
+def active_cloud_provider(kube_version):
+    '''Return the (cloud-provider, needs cloud-config) pair for the ready
+    cloud integration, or (None, False) if there is none.'''
+    for endpoint, provider, needs_cloud_config in cloud_providers:
+        if not is_state('endpoint.{}.ready'.format(endpoint)):
+            continue
+        if endpoint == 'vsphere' and kube_version < (1, 12):
+            continue
+        return provider, needs_cloud_config
+    return None, False
 
-    # at one point in time, this code would set ca-client-cert,
-    # but this was removed. This was before configure_kubernetes_service
-    # kept track of old arguments and removed them, so client-ca-cert
-    # was able to hang around forever stored in the snap configuration.
-    # This removes that stale configuration from the snap if it still
-    # exists.
-    api_opts['client-ca-file'] = 'null'
+
+def service_fingerprint(service, opts, extra_args_key):
+    '''Return a digest of everything a restart of service would pick up: the
+    snap revision, its options and extra args, and the contents of the input
+    files the options point at and of its systemd drop-ins.'''
+    try:
+        revision = os.readlink('/snap/{}/current'.format(service))
+    except OSError:
+        revision = None
+    digest = hashlib.sha256()
+    state = [revision, opts, hookenv.config(extra_args_key)]
+    digest.update(json.dumps(state, sort_keys=True).encode('utf-8'))
+    paths = set(str(v) for k, v in opts.items() if k in input_file_opts)
+    dropin_dir = '/etc/systemd/system/snap.{}.daemon.service.d'.format(
+        service)
+    try:
+        paths.update(os.path.join(dropin_dir, name)
+                     for name in os.listdir(dropin_dir)
+                     if name.endswith('.conf'))
+    except FileNotFoundError:
+        pass
+    for value in sorted(paths):
+        if os.path.isfile(value):
+            with open(value, 'rb') as f:
+                digest.update(value.encode('utf-8'))
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+def configure_service_if_changed(service, opts, extra_args_key):
+    '''Apply opts to service and restart it, unless nothing has changed since
+    the last restart and the service is still running.'''
+    daemon = 'snap.{}.daemon'.format(service)
+    fingerprint = service_fingerprint(service, opts, extra_args_key)
+    db_key = 'kubernetes-master.fingerprint.' + service
+    if (_db().get(db_key) == fingerprint and
+            host.service_running(daemon)):
+        hookenv.log('{} is unchanged, not restarting it'.format(service))
+        return
+    configure_kubernetes_service(configure_prefix, service, opts,
+                                 extra_args_key)
+    service_restart(daemon)
+    _db().set(db_key, fingerprint)
+    _db().set('kubernetes-master.fingerprint-opts.' + service,
+              {'opts': opts, 'extra_args_key': extra_args_key})
+
+
+def restart_service(service):
+    '''Restart service outside of configure_service_if_changed, e.g. after
+    one of its input files changed, and refresh its stored fingerprint so
+    the next configure does not restart it again.'''
+    service_restart('snap.{}.daemon'.format(service))
+    applied = _db().get('kubernetes-master.fingerprint-opts.' + service)
+    if applied:
+        _db().set('kubernetes-master.fingerprint.' + service,
+                  service_fingerprint(service, applied['opts'],
+                                      applied['extra_args_key']))
+
+
+def configure_apiserver(etcd_connection_string):
+    api_opts = dict(apiserver_static_opts)
+    config = hookenv.config()
+    kube_version = get_version('kube-apiserver')
 
     if is_privileged():
         api_opts['allow-privileged'] = 'true'
@@ -1580,62 +2155,14 @@ def configure_apiserver(etcd_connection_string):
         api_opts['allow-privileged'] = 'false'
         remove_state('kubernetes-master.privileged')
 
-    # Handle static options for now
     api_opts['service-cluster-ip-range'] = service_cidr()
-    api_opts['min-request-timeout'] = '300'
-    api_opts['v'] = '4'
-    api_opts['tls-cert-file'] = str(server_crt_path)
-    api_opts['tls-private-key-file'] = str(server_key_path)
-    api_opts['kubelet-certificate-authority'] = str(ca_crt_path)
-    api_opts['kubelet-client-certificate'] = str(client_crt_path)
-    api_opts['kubelet-client-key'] = str(client_key_path)
-    api_opts['logtostderr'] = 'true'
-    api_opts['insecure-bind-address'] = '127.0.0.1'
-    api_opts['insecure-port'] = '8080'
     api_opts['storage-backend'] = getStorageBackend()
-    api_opts['basic-auth-file'] = '/root/cdk/basic_auth.csv'
-
-    api_opts['token-auth-file'] = '/root/cdk/known_tokens.csv'
-    api_opts['service-account-key-file'] = '/root/cdk/serviceaccount.key'
-    api_opts['kubelet-preferred-address-types'] = \
-        'InternalIP,Hostname,InternalDNS,ExternalDNS,ExternalIP'
     api_opts['advertise-address'] = get_ingress_address('kube-control')
-
-    etcd_dir = '/root/cdk/etcd'
-    etcd_ca = os.path.join(etcd_dir, 'client-ca.pem')
-    etcd_key = os.path.join(etcd_dir, 'client-key.pem')
-    etcd_cert = os.path.join(etcd_dir, 'client-cert.pem')
-
-    api_opts['etcd-cafile'] = etcd_ca
-    api_opts['etcd-keyfile'] = etcd_key
-    api_opts['etcd-certfile'] = etcd_cert
     api_opts['etcd-servers'] = etcd_connection_string
 
-    admission_control_pre_1_9 = [
-        'NamespaceLifecycle',
-        'LimitRanger',
-        'ServiceAccount',
-        'ResourceQuota',
-        'DefaultTolerationSeconds'
-    ]
-
-    admission_control = [
-        'NamespaceLifecycle',
-        'LimitRanger',
-        'ServiceAccount',
-        'PersistentVolumeLabel',
-        'DefaultStorageClass',
-        'DefaultTolerationSeconds',
-        'MutatingAdmissionWebhook',
-        'ValidatingAdmissionWebhook',
-        'ResourceQuota'
-    ]
-
-    auth_mode = hookenv.config('authorization-mode')
-    if 'Node' in auth_mode:
-        admission_control.append('NodeRestriction')
+    auth_mode = config.get('authorization-mode')
 
-    ks = endpoint_from_flag('keystone-credentials.available.auth')
+    ks = _endpoint_from_flag('keystone-credentials.available.auth')
     ks_ip = None
     if ks:
         ks_ip = get_service_ip('k8s-keystone-auth-service', errors_fatal=False)
@@ -1645,10 +2172,11 @@ def configure_apiserver(etcd_connection_string):
         keystone_webhook = keystone_root + '/webhook.yaml'
         context = {}
         context['keystone_service_cluster_ip'] = ks_ip
-        render('keystone-api-server-webhook.yaml', keystone_webhook, context)
+        write_if_changed(keystone_webhook, render(
+            'keystone-api-server-webhook.yaml', None, context))
         api_opts['authentication-token-webhook-config-file'] = keystone_webhook
 
-        if hookenv.config('enable-keystone-authorization'):
+        if config.get('enable-keystone-authorization'):
             # if user wants authorization, enable it
             if 'Webhook' not in auth_mode:
                 auth_mode += ",Webhook"
@@ -1668,62 +2196,39 @@ def configure_apiserver(etcd_connection_string):
             # is related and trying to come up until we can find the
             # service IP.
             if 'Webhook' in auth_mode:
-                auth_mode = ','.join([i for i in auth_mode.split(',')
-                                      if i != 'Webhook'])
+                auth_mode = webhook_mode_re.sub('', auth_mode).lstrip(',')
         elif is_state('leadership.set.keystone-cdk-addons-configured'):
             hookenv.log('Unable to find keystone endpoint. Will retry')
         remove_state('keystone.apiserver.configured')
 
     api_opts['authorization-mode'] = auth_mode
 
-    kube_version = get_version('kube-apiserver')
     if kube_version < (1, 6):
         hookenv.log('Removing DefaultTolerationSeconds from admission-control')
-        admission_control_pre_1_9.remove('DefaultTolerationSeconds')
-    if kube_version < (1, 9):
-        api_opts['admission-control'] = ','.join(admission_control_pre_1_9)
+        api_opts['admission-control'] = admission_control_pre_1_6
+    elif kube_version < (1, 9):
+        api_opts['admission-control'] = admission_control_pre_1_9
+    elif 'Node' in auth_mode:
+        api_opts['admission-control'] = \
+            admission_control + ',NodeRestriction'
     else:
-        api_opts['admission-control'] = ','.join(admission_control)
+        api_opts['admission-control'] = admission_control
 
     if kube_version > (1, 6) and \
-       hookenv.config('enable-metrics'):
-        api_opts['requestheader-client-ca-file'] = str(ca_crt_path)
-        api_opts['requestheader-allowed-names'] = 'system:kube-apiserver'
-        api_opts['requestheader-extra-headers-prefix'] = 'X-Remote-Extra-'
-        api_opts['requestheader-group-headers'] = 'X-Remote-Group'
-        api_opts['requestheader-username-headers'] = 'X-Remote-User'
-        api_opts['proxy-client-cert-file'] = str(client_crt_path)
-        api_opts['proxy-client-key-file'] = str(client_key_path)
-        api_opts['enable-aggregator-routing'] = 'true'
-        api_opts['client-ca-file'] = str(ca_crt_path)
-
-    api_cloud_config_path = cloud_config_path('kube-apiserver')
-    if is_state('endpoint.aws.ready'):
-        api_opts['cloud-provider'] = 'aws'
-    elif is_state('endpoint.gcp.ready'):
-        api_opts['cloud-provider'] = 'gce'
-        api_opts['cloud-config'] = str(api_cloud_config_path)
-    elif is_state('endpoint.openstack.ready'):
-        api_opts['cloud-provider'] = 'openstack'
-        api_opts['cloud-config'] = str(api_cloud_config_path)
-    elif (is_state('endpoint.vsphere.ready') and
-          get_version('kube-apiserver') >= (1, 12)):
-        api_opts['cloud-provider'] = 'vsphere'
-        api_opts['cloud-config'] = str(api_cloud_config_path)
-    elif is_state('endpoint.azure.ready'):
-        api_opts['cloud-provider'] = 'azure'
-        api_opts['cloud-config'] = str(api_cloud_config_path)
-
-    audit_root = '/root/cdk/audit'
-    os.makedirs(audit_root, exist_ok=True)
+       config.get('enable-metrics'):
+        api_opts.update(apiserver_metrics_opts)
 
-    audit_log_path = audit_root + '/audit.log'
-    api_opts['audit-log-path'] = audit_log_path
-    api_opts['audit-log-maxsize'] = '100'
-    api_opts['audit-log-maxbackup'] = '9'
+    cloud_provider, needs_cloud_config = active_cloud_provider(kube_version)
+    if cloud_provider:
+        api_opts['cloud-provider'] = cloud_provider
+        if needs_cloud_config:
+            api_opts['cloud-config'] = \
+                str(cloud_config_path('kube-apiserver'))
+
+    os.makedirs(audit_root, exist_ok=True)
 
     audit_policy_path = audit_root + '/audit-policy.yaml'
-    audit_policy = hookenv.config('audit-policy')
+    audit_policy = config.get('audit-policy')
     if audit_policy:
         write_file_with_autogenerated_header(audit_policy_path, audit_policy)
         api_opts['audit-policy-file'] = audit_policy_path
@@ -1731,7 +2236,7 @@ def configure_apiserver(etcd_connection_string):
         remove_if_exists(audit_policy_path)
 
     audit_webhook_config_path = audit_root + '/audit-webhook-config.yaml'
-    audit_webhook_config = hookenv.config('audit-webhook-config')
+    audit_webhook_config = config.get('audit-webhook-config')
     if audit_webhook_config:
         write_file_with_autogenerated_header(audit_webhook_config_path,
                                              audit_webhook_config)
@@ -1743,46 +2248,23 @@ def configure_apiserver(etcd_connection_string):
         api_opts['experimental-encryption-provider-config'] = \
             str(encryption_config_path())
 
-    configure_kubernetes_service(configure_prefix, 'kube-apiserver',
-                                 api_opts, 'api-extra-args')
-    service_restart('snap.kube-apiserver.daemon')
+    configure_service_if_changed('kube-apiserver', api_opts,
+                                 'api-extra-args')
 
 
 def configure_controller_manager():
-    controller_opts = {}
+    controller_opts = dict(controller_manager_static_opts)
 
-    # Default to 3 minute resync. TODO: Make this configurable?
-    controller_opts['min-resync-period'] = '3m'
-    controller_opts['v'] = '2'
-    controller_opts['root-ca-file'] = str(ca_crt_path)
-    controller_opts['logtostderr'] = 'true'
-    controller_opts['master'] = 'http://127.0.0.1:8080'
-    controller_opts['service-account-private-key-file'] = \
-        '/root/cdk/serviceaccount.key'
-    controller_opts['tls-cert-file'] = str(server_crt_path)
-    controller_opts['tls-private-key-file'] = str(server_key_path)
-
-    cm_cloud_config_path = cloud_config_path('kube-controller-manager')
-    if is_state('endpoint.aws.ready'):
-        controller_opts['cloud-provider'] = 'aws'
-    elif is_state('endpoint.gcp.ready'):
-        controller_opts['cloud-provider'] = 'gce'
-        controller_opts['cloud-config'] = str(cm_cloud_config_path)
-    elif is_state('endpoint.openstack.ready'):
-        controller_opts['cloud-provider'] = 'openstack'
-        controller_opts['cloud-config'] = str(cm_cloud_config_path)
-    elif (is_state('endpoint.vsphere.ready') and
-          get_version('kube-apiserver') >= (1, 12)):
-        controller_opts['cloud-provider'] = 'vsphere'
-        controller_opts['cloud-config'] = str(cm_cloud_config_path)
-    elif is_state('endpoint.azure.ready'):
-        controller_opts['cloud-provider'] = 'azure'
-        controller_opts['cloud-config'] = str(cm_cloud_config_path)
-
-    configure_kubernetes_service(configure_prefix, 'kube-controller-manager',
-                                 controller_opts,
+    cloud_provider, needs_cloud_config = active_cloud_provider(
+        get_version('kube-apiserver'))
+    if cloud_provider:
+        controller_opts['cloud-provider'] = cloud_provider
+        if needs_cloud_config:
+            controller_opts['cloud-config'] = \
+                str(cloud_config_path('kube-controller-manager'))
+
+    configure_service_if_changed('kube-controller-manager', controller_opts,
                                  'controller-manager-extra-args')
-    service_restart('snap.kube-controller-manager.daemon')
 
 
 def configure_scheduler():
@@ -1817,47 +2299,73 @@ def setup_basic_auth(password=None, username='admin', uid='admin',
 
     for row in rows:
         if row[1] == username or row[2] == uid:
+            if row == new_row:
+                # nothing to do, leave the file alone
+                return
             # update existing entry based on username or uid
             row[:] = new_row
             break
     else:
         # append new entry
-        rows.append(new_row)
+        with htaccess.open('a') as f:
+            csv.writer(f).writerow(new_row)
+        _parse_credentials.cache_clear()
+        return
 
     with htaccess.open('w') as f:
         csv.writer(f).writerows(rows)
+    _parse_credentials.cache_clear()
 
 
 def setup_tokens(token, username, user, groups=None):
     '''Create a token file for kubernetes authentication.'''
-    root_cdk = '/root/cdk'
-    if not os.path.isdir(root_cdk):
-        os.makedirs(root_cdk)
-    known_tokens = os.path.join(root_cdk, 'known_tokens.csv')
     if not token:
         token = token_generator()
-    with open(known_tokens, 'a') as stream:
-        if groups:
-            stream.write('{0},{1},{2},"{3}"\n'.format(token,
-                                                      username,
-                                                      user,
-                                                      groups))
-        else:
-            stream.write('{0},{1},{2}\n'.format(token, username, user))
+    append_tokens([(token, username, user, groups)])
 
 
-def get_password(csv_fname, user):
-    '''Get the password of user within the csv file provided.'''
-    root_cdk = '/root/cdk'
-    tokens_fname = os.path.join(root_cdk, csv_fname)
-    if not os.path.isfile(tokens_fname):
-        return None
-    with open(tokens_fname, 'r') as stream:
+def append_tokens(entries):
+    '''Append (token, username, user, groups) entries to the token file
+    in a single write.'''
+    os.makedirs('/root/cdk', exist_ok=True)
+    with open('/root/cdk/known_tokens.csv', 'a', newline='') as stream:
+        writer = csv.writer(stream, lineterminator='\n')
+        for token, username, user, groups in entries:
+            if groups:
+                writer.writerow([token, username, user, groups])
+            else:
+                writer.writerow([token, username, user])
+    _parse_credentials.cache_clear()
+
+
+def _load_credentials(csv_fname):
+    '''Return a {user: password} map of the csv file in /root/cdk. The
+    first entry for a user wins. The file is only re-parsed when it has
+    changed on disk.'''
+    path = os.path.join('/root/cdk', csv_fname)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    return _parse_credentials(path, st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_credentials(path, ino, mtime_ns, size):
+    credentials = {}
+    with open(path, 'r') as stream:
         for line in stream:
             record = line.split(',')
-            if record[1] == user:
-                return record[0]
-    return None
+            # Files copied from the leader end with a blank line.
+            if len(record) < 2:
+                continue
+            credentials.setdefault(record[1], record[0])
+    return credentials
+
+
+def get_password(csv_fname, user):
+    '''Get the password of user within the csv file provided.'''
+    return _load_credentials(csv_fname).get(user)
 
 
 def get_token(username):
@@ -1865,28 +2373,58 @@ def get_token(username):
     return get_password('known_tokens.csv', username)
 
 
+def load_tokens():
+    '''Return a {username: token} map of the static token file.'''
+    return dict(_load_credentials('known_tokens.csv'))
+
+
+def ensure_token(username, user, groups=None, tokens=None, pending=None):
+    '''Return the token for username, creating one if it doesn't exist yet.
+
+    tokens is an optional map from load_tokens() to look the user up in. If
+    pending is given, new entries are queued on it for append_tokens()
+    instead of being written straight away.'''
+    if tokens is None:
+        token = get_token(username)
+    else:
+        token = tokens.get(username)
+    if token:
+        return token
+    token = token_generator()
+    if tokens is not None:
+        tokens[username] = token
+    if pending is None:
+        setup_tokens(token, username, user, groups)
+    else:
+        pending.append((token, username, user, groups))
+    return token
+
+
 def set_token(password, save_salt):
     ''' Store a token so it can be recalled later by token_generator.
 
     param: password - the password to be stored
     param: save_salt - the key to store the value of the token.'''
-    db.set(save_salt, password)
-    return db.get(save_salt)
+    _db().set(save_salt, password)
+    return _db().get(save_salt)
 
 
 def token_generator(length=32):
     ''' Generate a random token for use in passwords and account tokens.
 
     param: length - the length of the token to generate'''
-    alpha = string.ascii_letters + string.digits
-    token = ''.join(random.SystemRandom().choice(alpha) for _ in range(length))
-    return token
+    token = b''
+    while len(token) < length:
+        # bytes that would bias the alphabet are dropped by translate()
+        token += os.urandom(length * 2).translate(token_table, token_bias)
+    return token[:length].decode('ascii')
 
 
 @retry(times=3, delay_secs=1)
 def get_pods(namespace='default'):
     try:
         output = kubectl(
+            kubectl_cache_arg(),
             'get', 'po',
             '-n', namespace,
             '-o', 'json',
@@ -1914,26 +2452,52 @@ def get_kube_system_pods_not_running():
     if result is None:
         raise FailedToGetPodStatus
 
-    hookenv.log('Checking system pods status: {}'.format(', '.join(
-        '='.join([pod['metadata']['name'], pod['status']['phase']])
-        for pod in result['items'])))
-
-    # Pods that are Running or Evicted (which should re-spawn) are
-    # considered running
-    not_running = [pod for pod in result['items']
-                   if pod['status']['phase'] != 'Running'
-                   and pod['status'].get('reason', '') != 'Evicted']
+    # Classify every pod in a single pass. Pods that are Running or
+    # Evicted (which should re-spawn) are considered running.
+    statuses = []
+    not_running = []
+    any_pending = False
+    for pod in result['items']:
+        status = pod['status']
+        phase = status['phase']
+        statuses.append(pod['metadata']['name'] + '=' + phase)
+        if phase != 'Running' and status.get('reason', '') != 'Evicted':
+            not_running.append(pod)
+        if phase == 'Pending':
+            any_pending = True
+
+    hookenv.log('Checking system pods status: {}'.format(', '.join(statuses)))
 
-    pending = [pod for pod in result['items']
-               if pod['status']['phase'] == 'Pending']
-    any_pending = len(pending) > 0
     if is_state('endpoint.gcp.ready') and any_pending:
         poke_network_unavailable()
-        return not_running
 
     return not_running
 
 
+# stop checking ServiceAccount secrets for the new CA after this many
+# mismatches
+max_logged_ca_mismatches = 5
+
+# label on the workloads to restart when the CA changes, and their kinds
+# with the matching apps/v1 resource
+addon_restart_selector = 'cdk-restart-on-ca-change=true'
+addon_workload_kinds = (
+    ('DaemonSet', 'daemonsets'),
+    ('Deployment', 'deployments'),
+    ('StatefulSet', 'statefulsets'),
+)
+
+# seconds to wait before poking the same node's status again
+poke_interval = 30
+
+network_available_condition = {
+    "type": "NetworkUnavailable",
+    "status": "False",
+    "reason": "RouteCreated",
+    "message": "Manually set through k8s api",
+}
+
+
 def poke_network_unavailable():
     """
     Work around https://github.com/kubernetes/kubernetes/issues/44254 by
@@ -1945,7 +2509,7 @@ def poke_network_unavailable():
     discussion about refactoring the affected code but nothing has happened
     in a while.
     """
-    cmd = ['kubectl', 'get', 'nodes', '-o', 'json']
+    cmd = ['kubectl', kubectl_cache_arg(), 'get', 'nodes', '-o', 'json']
 
     try:
         output = check_output(cmd).decode('utf-8')
@@ -1958,49 +2522,95 @@ def poke_network_unavailable():
                     '({}): {}'.format(e, output), hookenv.ERROR)
         return
 
+    # The node list already carries the status conditions, so only the
+    # nodes that still need poking are sent back, concurrently.
+    stale = []
     for node in nodes:
-        node_name = node['metadata']['name']
-        url = 'http://localhost:8080/api/v1/nodes/{}/status'.format(node_name)
-        with urlopen(url) as response:
-            code = response.getcode()
-            body = response.read().decode('utf8')
-        if code != 200:
-            hookenv.log('failed to get node status from {} [{}]: {}'.format(
-                url, code, body), hookenv.ERROR)
-            return
         try:
-            node_info = json.loads(body)
-            conditions = node_info['status']['conditions']
-            i = [c['type'] for c in conditions].index('NetworkUnavailable')
-            if conditions[i]['status'] == 'True':
-                hookenv.log('Clearing NetworkUnavailable from {}'.format(
-                    node_name))
-                conditions[i] = {
-                    "type": "NetworkUnavailable",
-                    "status": "False",
-                    "reason": "RouteCreated",
-                    "message": "Manually set through k8s api",
-                }
-                req = Request(url, method='PUT',
-                              data=json.dumps(node_info).encode('utf8'),
-                              headers={'Content-Type': 'application/json'})
-                with urlopen(req) as response:
-                    code = response.getcode()
-                    body = response.read().decode('utf8')
-                if code not in (200, 201, 202):
-                    hookenv.log('failed to update node status [{}]: {}'.format(
-                        code, body), hookenv.ERROR)
-                    return
-        except (json.JSONDecodeError, KeyError):
-            hookenv.log('failed to parse node status: {}'.format(body),
+            conditions = node['status']['conditions']
+        except KeyError:
+            hookenv.log('failed to parse node status: {}'.format(node),
                         hookenv.ERROR)
-            return
+            continue
+        for condition in conditions:
+            if condition['type'] == 'NetworkUnavailable':
+                if condition['status'] == 'True':
+                    stale.append(node)
+                break
+    # Skip nodes that were poked very recently; the apiserver may just not
+    # have caught up yet. Hooks run in separate processes, so the poke
+    # times are kept in unitdata.
+    poked = _db().get('kubernetes-master.network-unavailable-poked') or {}
+    now = time.time()
+    stale = [node for node in stale
+             if now - poked.get(node['metadata']['name'], 0) >= poke_interval]
+    if not stale:
+        return
+    # Each worker gets its own share of the nodes and a single keep-alive
+    # connection to the apiserver for all of them.
+    workers = min(len(stale), 16)
+    batches = [stale[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_clear_network_unavailable, batches))
+    names = set(node['metadata']['name'] for node in nodes)
+    poked = {name: ts for name, ts in poked.items() if name in names}
+    for batch, cleared in zip(batches, results):
+        for node, ok in zip(batch, cleared):
+            if ok:
+                poked[node['metadata']['name']] = now
+    _db().set('kubernetes-master.network-unavailable-poked', poked)
+
+
+def _clear_network_unavailable(nodes):
+    '''Patch each node's status to set NetworkUnavailable to False, over
+    one connection. Returns a list of per-node success flags.'''
+    conn = http.client.HTTPConnection('localhost', 8080, timeout=30)
+    results = []
+    try:
+        for node in nodes:
+            results.append(_patch_node_status(conn, node))
+    finally:
+        conn.close()
+    return results
+
+
+def _patch_node_status(conn, node):
+    node_name = node['metadata']['name']
+    hookenv.log('Clearing NetworkUnavailable from {}'.format(node_name))
+    path = '/api/v1/nodes/{}/status'.format(node_name)
+    # A strategic merge patch merges node conditions by type, so only the
+    # one condition is sent and the others are left untouched.
+    patch = {'status': {'conditions': [network_available_condition]}}
+    conn.request('PATCH', path, body=json.dumps(patch).encode('utf8'),
+                 headers={'Content-Type':
+                          'application/strategic-merge-patch+json'})
+    response = conn.getresponse()
+    code = response.status
+    body = response.read().decode('utf8')
+    if code not in (200, 201, 202):
+        hookenv.log('failed to update node status [{}]: {}'.format(
+            code, body), hookenv.ERROR)
+        return False
+    return True
 
 
-def apiserverVersion():
+def apiserver_version_string():
+    '''Return the output of `kube-apiserver --version`. The result is kept in
+    unitdata and the binary is only run again when the installed snap
+    revision changes.'''
+    try:
+        revision = os.readlink('/snap/kube-apiserver/current')
+    except OSError:
+        revision = None
+    cached = _db().get('kubernetes-master.apiserver-version')
+    if revision and cached and cached[1] == revision:
+        return cached[0]
     cmd = 'kube-apiserver --version'.split()
-    version_string = check_output(cmd).decode('utf-8')
-    return tuple(int(q) for q in re.findall("[0-9]+", version_string)[:3])
+    version_string = check_output(cmd).decode('utf-8').strip()
+    if revision:
+        _db().set('kubernetes-master.apiserver-version',
+                  [version_string, revision])
+    return version_string
 
 
 def touch(fname):
@@ -2013,7 +2623,7 @@ def touch(fname):
 def getStorageBackend():
     storage_backend = hookenv.config('storage-backend')
     if storage_backend == 'auto':
-        storage_backend = leader_get('auto_storage_backend')
+        storage_backend = leader_getc('auto_storage_backend')
     return storage_backend
 
 
@@ -2021,13 +2631,13 @@ def getStorageBackend():
 @when_not('leadership.set.cluster_tag')
 def create_cluster_tag():
     cluster_tag = 'kubernetes-{}'.format(token_generator().lower())
-    leader_set(cluster_tag=cluster_tag)
+    leader_setc(cluster_tag=cluster_tag)
 
 
 @when('leadership.set.cluster_tag',
       'kube-control.connected')
 def send_cluster_tag():
-    cluster_tag = leader_get('cluster_tag')
+    cluster_tag = leader_getc('cluster_tag')
     kube_control = endpoint_from_flag('kube-control.connected')
     kube_control.set_cluster_tag(cluster_tag)
 
@@ -2063,7 +2673,7 @@ def set_cloud_pending():
 @when_not('kubernetes-master.cloud.request-sent')
 def request_integration():
     hookenv.status_set('maintenance', 'requesting cloud integration')
-    cluster_tag = leader_get('cluster_tag')
+    cluster_tag = leader_getc('cluster_tag')
     if is_state('endpoint.aws.joined'):
         cloud = endpoint_from_flag('endpoint.aws.joined')
         cloud.tag_instance({
@@ -2127,18 +2737,18 @@ def clear_cloud_flags():
 @when_not('kubernetes-master.cloud.blocked',
           'kubernetes-master.cloud.ready')
 def cloud_ready():
-    if is_state('endpoint.gcp.ready'):
-        write_gcp_snap_config('kube-apiserver')
-        write_gcp_snap_config('kube-controller-manager')
-    elif is_state('endpoint.openstack.ready'):
-        write_openstack_snap_config('kube-apiserver')
-        write_openstack_snap_config('kube-controller-manager')
-    elif is_state('endpoint.vsphere.ready'):
-        _write_vsphere_snap_config('kube-apiserver')
-        _write_vsphere_snap_config('kube-controller-manager')
-    elif is_state('endpoint.azure.ready'):
-        write_azure_snap_config('kube-apiserver')
-        write_azure_snap_config('kube-controller-manager')
+    writers = {
+        'gcp': write_gcp_snap_config,
+        'openstack': write_openstack_snap_config,
+        'vsphere': _write_vsphere_snap_config,
+        'azure': write_azure_snap_config,
+    }
+    for endpoint, _, needs_cloud_config in cloud_providers:
+        if is_state('endpoint.{}.ready'.format(endpoint)):
+            if needs_cloud_config:
+                writers[endpoint]('kube-apiserver')
+                writers[endpoint]('kube-controller-manager')
+            break
     remove_state('kubernetes-master.cloud.pending')
     set_state('kubernetes-master.cloud.ready')
     remove_state('kubernetes-master.components.started')  # force restart
@@ -2167,7 +2777,7 @@ def _cdk_addons_template_path():
 
 def _write_vsphere_snap_config(component):
     # vsphere requires additional cloud config
-    vsphere = endpoint_from_flag('endpoint.vsphere.ready')
+    vsphere = _endpoint_from_flag('endpoint.vsphere.ready')
 
     # NB: vsphere provider will ask kube-apiserver and -controller-manager to
     # find a uuid from sysfs unless a global config value is set. Our strict
@@ -2226,7 +2836,7 @@ def setup_keystone_user():
 
 def _kick_apiserver():
     if is_flag_set('kubernetes-master.components.started'):
-        etcd = endpoint_from_flag('etcd.available')
+        etcd = _endpoint_from_flag('etcd.available')
         configure_apiserver(etcd.get_connection_string())
 
 
@@ -2249,7 +2859,7 @@ def keystone_kick_apiserver():
       'etcd.available', 'leadership.set.keystone-cdk-addons-configured')
 def keystone_config():
     # first, we have to have the service set up before we can render this stuff
-    ks = endpoint_from_flag('keystone-credentials.available.auth')
+    ks = _endpoint_from_flag('keystone-credentials.available.auth')
     data = {
         'host': ks.credentials_host(),
         'proto': ks.credentials_protocol(),
@@ -2260,8 +2870,8 @@ def keystone_config():
         remove_state('keystone.credentials.configured')
 
         # we basically just call the other things we need to update
-        etcd = endpoint_from_flag('etcd.available')
-        lb = endpoint_from_flag('loadbalancer.available')
+        etcd = _endpoint_from_flag('etcd.available')
+        lb = _endpoint_from_flag('loadbalancer.available')
 
         configure_apiserver(etcd.get_connection_string())
         if lb:
@@ -2331,44 +2941,63 @@ def _write_encryption_config():
     encryption_config_path().parent.mkdir(parents=True, exist_ok=True)
     secret = app_kv['encryption_key']
     secret = base64.b64encode(secret.encode('utf8')).decode('utf8')
-    host.write_file(
-        path=str(encryption_config_path()),
-        perms=0o600,
-        content=yaml.safe_dump({
-            'kind': 'EncryptionConfig',
-            'apiVersion': 'v1',
-            'resources': [{
-                'resources': ['secrets'],
-                'providers': [
-                    {'aescbc': {
-                        'keys': [{
-                            'name': 'key1',
-                            'secret': secret,
-                        }],
-                    }},
-                    {'identity': {}},
-                ]
-            }],
-        })
-    )
+    content = yaml.safe_dump({
+        'kind': 'EncryptionConfig',
+        'apiVersion': 'v1',
+        'resources': [{
+            'resources': ['secrets'],
+            'providers': [
+                {'aescbc': {
+                    'keys': [{
+                        'name': 'key1',
+                        'secret': secret,
+                    }],
+                }},
+                {'identity': {}},
+            ]
+        }],
+    })
+    path = encryption_config_path()
+    try:
+        if path.read_text() == content:
+            return
+    except FileNotFoundError:
+        pass
+    host.write_file(path=str(path), perms=0o600, content=content)
 
 
-def get_hacluster_ip_or_hostname():
-    hacluster = endpoint_from_flag('ha.connected')
-    if hacluster:
-        vips = hookenv.config('ha-cluster-vip').split()
-        dns_record = hookenv.config('ha-cluster-dns')
-        if vips:
-            # each unit will pick one based on unit number
-            return vips[get_unit_number() % len(vips)]
-        elif dns_record:
-            return dns_record
+@functools.lru_cache(maxsize=1)
+def _parse_hacluster_config(vip, dns):
+    return tuple((vip or '').split()), dns
 
+
+def get_hacluster_config():
+    '''Return the configured hacluster (vips, dns_record).'''
+    config = hookenv.config()
+    return _parse_hacluster_config(config.get('ha-cluster-vip'),
+                                   config.get('ha-cluster-dns'))
+
+
+def get_hacluster_ip_or_hostname():
+    if _endpoint_from_flag('ha.connected'):
+        return _hacluster_address()
     return None
 
 
+@functools.lru_cache(maxsize=1)
+def _hacluster_address():
+    '''Return the VIP or DNS record this unit should advertise. Depends only
+    on config and the unit number, so it is resolved once per hook.'''
+    vips, dns_record = get_hacluster_config()
+    if vips:
+        # each unit will pick one based on unit number
+        return vips[get_unit_number() % len(vips)]
+    return dns_record or None
+
+
 @when_any('config.changed.ha-cluster-vip', 'config.changed.ha-cluster-dns')
 def haconfig_changed():
+    _hacluster_address.cache_clear()
     clear_flag('hacluster-configured')
 
 
@@ -2415,28 +3044,36 @@ class InvalidDnsProvider(Exception):
 
 
 def get_dns_provider():
-    valid_dns_providers = ['auto', 'core-dns', 'kube-dns', 'none']
-    if get_version('kube-apiserver') < (1, 14):
-        valid_dns_providers.remove('core-dns')
+    dns_provider = _resolve_dns_provider()
+
+    # LP: 1833089. Followers end up here when setting final status; ensure only
+    # leaders call leader_set. Skip the write when it would be a no-op.
+    if is_state('leadership.is_leader') and \
+            leader_getc('auto_dns_provider') != dns_provider:
+        leader_setc(auto_dns_provider=dns_provider)
+    return dns_provider
+
+
+@functools.lru_cache(maxsize=1)
+def _resolve_dns_provider():
+    '''Work out the DNS provider from config and leader data. Neither changes
+    during a hook other than through get_dns_provider itself, so the answer
+    is kept for the rest of the hook.'''
+    supports_coredns = get_version('kube-apiserver') >= (1, 14)
 
     dns_provider = hookenv.config('dns-provider').lower()
-    if dns_provider not in valid_dns_providers:
+    if dns_provider not in valid_dns_providers[supports_coredns]:
         raise InvalidDnsProvider(dns_provider)
 
     if dns_provider == 'auto':
-        dns_provider = leader_get('auto_dns_provider')
+        dns_provider = leader_getc('auto_dns_provider')
         # On new deployments, the first time this is called, auto_dns_provider
         # hasn't been set yet. We need to make a choice now.
         if not dns_provider:
-            if 'core-dns' in valid_dns_providers:
+            if supports_coredns:
                 dns_provider = 'core-dns'
             else:
                 dns_provider = 'kube-dns'
-
-    # LP: 1833089. Followers end up here when setting final status; ensure only
-    # leaders call leader_set.
-    if is_state('leadership.is_leader'):
-        leader_set(auto_dns_provider=dns_provider)
     return dns_provider
 
 
@@ -2454,104 +3091,218 @@ def send_new_registry_location():
     clear_flag('kubernetes-master.sent-registry')
 
 
+def get_ca_digests():
+    '''Return the (sha256 hex, base64) forms of the cluster CA. They are
+    only recomputed when the file changes on disk.'''
+    st = os.stat(str(ca_crt_path))
+    return _ca_digests(st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=1)
+def _ca_digests(ino, mtime_ns, size):
+    with open(ca_crt_path, 'rb') as f:
+        ca = f.read()
+    return (hashlib.sha256(ca).hexdigest(),
+            base64.b64encode(ca).decode('UTF-8'))
+
+
+def _apiserver_get(conn, path, **params):
+    '''GET path from the local apiserver over conn and return the decoded
+    JSON body.'''
+    if params:
+        path += '?' + urlencode(params)
+    conn.request('GET', path)
+    response = conn.getresponse()
+    body = response.read().decode('utf-8')
+    if response.status != 200:
+        raise OSError('GET {} failed [{}]: {}'.format(
+            path, response.status, body))
+    return json.loads(body)
+
+
+def _apiserver_get_many(requests, max_workers=8):
+    '''GET each (path, params) pair from the local apiserver concurrently and
+    return the decoded bodies in order. Each worker sends its share of the
+    requests over its own keep-alive connection.'''
+    if not requests:
+        return []
+    workers = min(len(requests), max_workers)
+    batches = [requests[i::workers] for i in range(workers)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch_results = list(executor.map(_apiserver_get_batch, batches))
+    results = [None] * len(requests)
+    for i, batch_result in enumerate(batch_results):
+        results[i::workers] = batch_result
+    return results
+
+
+def _apiserver_get_batch(requests):
+    conn = http.client.HTTPConnection('localhost', 8080, timeout=30)
+    try:
+        return [_apiserver_get(conn, path, **params)
+                for path, params in requests]
+    finally:
+        conn.close()
+
+
+def _first_stale_secret(secrets, encoded_ca):
+    '''Return the name of the first (namespace, name) secret that still has
+    a ca.crt other than encoded_ca, or None. Secrets that cannot be fetched
+    are skipped, leaving the full check to decide.'''
+    conn = http.client.HTTPConnection('localhost', 8080, timeout=30)
+    try:
+        for namespace, name in secrets:
+            path = '/api/v1/namespaces/{}/secrets/{}'.format(namespace, name)
+            try:
+                secret = _apiserver_get(conn, path)
+            except (OSError, http.client.HTTPException):
+                continue
+            if secret.get('data', {}).get('ca.crt') != encoded_ca:
+                return name
+    finally:
+        conn.close()
+    return None
+
+
 @when('leadership.is_leader',
       'leadership.set.kubernetes-master-addons-restart-for-ca',
       'kubernetes-master.components.started')
 def restart_addons_for_ca():
-    try:
-        # Get deployments/daemonsets/statefulsets
-        output = kubectl(
-            'get', 'daemonset,deployment,statefulset',
-            '-o', 'json',
-            '--all-namespaces',
-            '-l', 'cdk-restart-on-ca-change=true'
-        ).decode('UTF-8')
-        deployments = json.loads(output)['items']
+    # The CA file is rewritten on every tls_client.ca.written, even when it
+    # has not changed. Skip the restarts if they already ran for this CA.
+    ca_hash, encoded_ca = get_ca_digests()
+    if leader_getc('kubernetes-master-addons-restarted-for-ca') == ca_hash:
+        hookenv.log('Addons already restarted for this CA')
+        leader_setc({'kubernetes-master-addons-restart-for-ca': None})
+        return
 
-        # Get ServiceAccounts
-        service_account_names = set(
-            (
-                deployment['metadata']['namespace'],
-                deployment['spec']['template']['spec'].get(
+    # If the last attempt for this CA was waiting on stale secrets and one
+    # of them is still stale, there is no point enumerating the cluster
+    # again yet.
+    stale = _db().get('kubernetes-master.ca-stale-secrets')
+    if stale and stale['ca'] == ca_hash:
+        name = _first_stale_secret(stale['secrets'], encoded_ca)
+        if name:
+            hookenv.log(
+                'ServiceAccount secret still does not have correct ca.crt: '
+                + name
+            )
+            hookenv.log('Waiting to retry restarting addons')
+            return
+
+    # Talk to the local apiserver directly, with the GETs of each stage
+    # issued concurrently, rather than forking kubectl for every object.
+    try:
+        # Get deployments/daemonsets/statefulsets. Only the few fields used
+        # below are kept, so the full objects are not held for the rest of
+        # the handler.
+        results = _apiserver_get_many([
+            ('/apis/apps/v1/' + resource,
+             {'labelSelector': addon_restart_selector})
+            for _, resource in addon_workload_kinds
+        ])
+        # The ServiceAccounts to check are collected in the same pass.
+        deployments = []
+        service_account_names = set()
+        for (kind, _), result in zip(addon_workload_kinds, results):
+            for deployment in result['items']:
+                namespace = deployment['metadata']['namespace']
+                service_account = deployment['spec']['template']['spec'].get(
                     'serviceAccountName', 'default'
                 )
-            )
-            for deployment in deployments
-        )
-        service_accounts = []
-        for namespace, name in service_account_names:
-            output = kubectl(
-                'get', 'ServiceAccount', name,
-                '-o', 'json',
-                '-n', namespace
-            ).decode('UTF-8')
-            service_account = json.loads(output)
-            service_accounts.append(service_account)
+                deployments.append(
+                    (kind, namespace, deployment['metadata']['name']))
+                service_account_names.add((namespace, service_account))
 
-        # Get ServiceAccount secrets
+        # Get ServiceAccounts
+        service_accounts = _apiserver_get_many([
+            ('/api/v1/namespaces/{}/serviceaccounts/{}'.format(
+                namespace, name), {})
+            for namespace, name in sorted(service_account_names)
+        ])
+
+        # Get ServiceAccount secrets, with one list of the token secrets per
+        # namespace rather than a GET per secret. Only the name and ca.crt
+        # of each secret are kept.
         secret_names = set()
+        namespaces = set()
         for service_account in service_accounts:
             namespace = service_account['metadata']['namespace']
             for secret in service_account['secrets']:
                 secret_names.add((namespace, secret['name']))
-        secrets = []
-        for namespace, name in secret_names:
-            output = kubectl(
-                'get', 'Secret', name,
-                '-o', 'json',
-                '-n', namespace
-            ).decode('UTF-8')
-            secret = json.loads(output)
-            secrets.append(secret)
-
-        # Check secrets have updated CA
-        with open(ca_crt_path, 'rb') as f:
-            ca = f.read()
-        encoded_ca = base64.b64encode(ca).decode('UTF-8')
-        mismatched_secrets = [
-            secret for secret in secrets
-            if secret['data']['ca.crt'] != encoded_ca
-        ]
+                namespaces.add(namespace)
+        namespaces = sorted(namespaces)
+        results = _apiserver_get_many([
+            ('/api/v1/namespaces/{}/secrets'.format(namespace),
+             {'fieldSelector': 'type=kubernetes.io/service-account-token'})
+            for namespace in namespaces
+        ])
+        secrets = {}
+        for namespace, result in zip(namespaces, results):
+            for secret in result['items']:
+                key = (namespace, secret['metadata']['name'])
+                if key in secret_names:
+                    secrets[key] = secret['data']['ca.crt']
+        if len(secrets) != len(secret_names):
+            hookenv.log('Not all ServiceAccount secrets were found')
+            hookenv.log('Waiting to retry restarting addons')
+            return
+
+        # Check secrets have updated CA. Stop at the first few mismatches;
+        # they are enough to explain the wait and the rest are rechecked on
+        # the next retry anyway.
+        mismatched_secrets = []
+        for key, secret_ca in secrets.items():
+            if secret_ca != encoded_ca:
+                mismatched_secrets.append(key)
+                if len(mismatched_secrets) >= max_logged_ca_mismatches:
+                    break
         if mismatched_secrets:
             hookenv.log(
                 'ServiceAccount secrets do not have correct ca.crt: '
-                + ','.join(
-                    secret['metadata']['name'] for secret in mismatched_secrets
-                )
+                + ','.join(name for _, name in mismatched_secrets)
             )
+            _db().set('kubernetes-master.ca-stale-secrets',
+                      {'ca': ca_hash, 'secrets': mismatched_secrets})
             hookenv.log('Waiting to retry restarting addons')
             return
 
-        # Now restart the addons
-        for deployment in deployments:
-            kind = deployment['kind']
-            namespace = deployment['metadata']['namespace']
-            name = deployment['metadata']['name']
+        # Now restart the addons, with one kubectl call per namespace
+        by_namespace = {}
+        for kind, namespace, name in deployments:
             hookenv.log('Restarting addon: %s %s %s' % (kind, namespace, name))
+            by_namespace.setdefault(namespace, []).append(kind + '/' + name)
+        for namespace, resources in sorted(by_namespace.items()):
             kubectl(
-                'rollout', 'restart', kind + '/' + name,
+                kubectl_cache_arg(),
+                'rollout', 'restart', *resources,
                 '-n', namespace
             )
 
-        leader_set({'kubernetes-master-addons-restart-for-ca': None})
+        leader_setc({'kubernetes-master-addons-restart-for-ca': None,
+                    'kubernetes-master-addons-restarted-for-ca': ca_hash})
+        _db().unset('kubernetes-master.ca-stale-secrets')
     except Exception:
         hookenv.log(traceback.format_exc())
         hookenv.log('Waiting to retry restarting addons')
 
 
+def _copy_if_changed(source, dest):
+    '''Copy source to dest unless dest already has the same content.
+    Returns True if dest was written.'''
+    return write_if_changed(dest, Path(source).read_bytes())
+
+
 def add_systemd_iptables_patch():
+    '''Install the kube-proxy iptables fix and its unit. Returns True if the
+    unit changed; the caller reloads systemd and starts it.'''
     source = 'templates/kube-proxy-iptables-fix.sh'
     dest = '/usr/local/bin/kube-proxy-iptables-fix.sh'
-    copyfile(source, dest)
+    _copy_if_changed(source, dest)
     os.chmod(dest, 0o775)
 
     template = 'templates/service-iptables-fix.service'
     dest_dir = '/etc/systemd/system'
     os.makedirs(dest_dir, exist_ok=True)
     service_name = 'kube-proxy-iptables-fix.service'
-    copyfile(template, '{}/{}'.format(dest_dir, service_name))
-
-    check_call(['systemctl', 'daemon-reload'])
-
-    # enable and run the service
-    service_resume(service_name)
+    return _copy_if_changed(template, '{}/{}'.format(dest_dir, service_name))